@@ -0,0 +1,281 @@
+'''
+Load test of the trivia endpoints.
+
+Seeds a synthetic question bank of each requested size, then drives
+GET /questions, POST /search_questions, GET /categories/<id>/questions
+and POST /quizzes with a reproducible mix of requests, through the Flask
+test client and through a threaded WSGI server over HTTP, and optionally
+(--transports asgi) through uvicorn serving flaskr.asgi. Each endpoint
+reports throughput and p50/p95/p99 latency, and the results are written
+as JSON. A previous results file can be compared against; the script then
+exits with status 1 when an endpoint regressed beyond the threshold.
+
+SQLite in a temporary file is used unless a database URL is given; the
+questions table of that database is replaced:
+
+    python benchmarks/bench_endpoints.py --rows 10000,100000 --output results.json
+    python benchmarks/bench_endpoints.py --database-url postgresql:///trivia_bench \\
+        --rows 1000000 --compare results.json
+'''
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from werkzeug.serving import make_server
+from models import create_schema, db, setup_db
+from flaskr import create_app
+from synthetic import WORDS, seed
+
+ENDPOINTS = ('questions', 'search_questions', 'category_questions', 'quizzes')
+TRANSPORTS = ('test_client', 'wsgi')
+
+
+'''
+request_mix(endpoint, rows, category_ids, count, seed)
+    the (method, path, body) of count requests to an endpoint, the same for
+    every run with the same seed
+'''
+def request_mix(endpoint, rows, category_ids, count, seed=0):
+  generator = random.Random('{}-{}'.format(endpoint, seed))
+  pages = max(1, min(rows // 10, 100))
+  requests = []
+  for _ in range(count):
+    if endpoint == 'questions':
+      requests.append(('GET', '/questions?page={}'.format(generator.randint(1, pages)), None))
+    elif endpoint == 'category_questions':
+      requests.append(('GET', '/categories/{}/questions?page={}'.format(
+        generator.choice(category_ids), generator.randint(1, max(1, pages // len(category_ids)))), None))
+    elif endpoint == 'search_questions':
+      requests.append(('POST', '/search_questions', {'search_term': generator.choice(WORDS)}))
+    else:
+      requests.append(('POST', '/quizzes', {
+        'quiz_category': generator.choice(category_ids),
+        'previous_questions': generator.sample(range(1, rows + 1), min(5, rows))}))
+  return requests
+
+
+def percentile(latencies, share):
+  # nearest rank on sorted latencies
+  return latencies[max(0, int(round(share * len(latencies))) - 1)]
+
+
+def summarize(latencies, errors, seconds):
+  latencies = sorted(latencies)
+  return {
+    'requests': len(latencies),
+    'errors': errors,
+    'seconds': round(seconds, 4),
+    'throughput': round(len(latencies) / seconds, 2),
+    'mean_ms': round(1000 * sum(latencies) / len(latencies), 3),
+    'p50_ms': round(1000 * percentile(latencies, 0.50), 3),
+    'p95_ms': round(1000 * percentile(latencies, 0.95), 3),
+    'p99_ms': round(1000 * percentile(latencies, 0.99), 3),
+  }
+
+
+def run_test_client(app, requests):
+  client = app.test_client()
+  latencies, errors = [], 0
+  start = time.perf_counter()
+  for method, path, body in requests:
+    sent = time.perf_counter()
+    response = client.open(path, method=method, json=body)
+    latencies.append(time.perf_counter() - sent)
+    errors += response.status_code >= 500
+  return latencies, errors, time.perf_counter() - start
+
+
+def run_http(port, requests, concurrency):
+  latencies, errors = [], [0]
+  lock = threading.Lock()
+  pending = iter(requests)
+
+  def worker():
+    while True:
+      with lock:
+        item = next(pending, None)
+      if item is None:
+        return
+      method, path, body = item
+      connection = http.client.HTTPConnection('127.0.0.1', port)
+      sent = time.perf_counter()
+      if body is None:
+        connection.request(method, path)
+      else:
+        connection.request(method, path, json.dumps(body), {'Content-Type': 'application/json'})
+      response = connection.getresponse()
+      response.read()
+      elapsed = time.perf_counter() - sent
+      connection.close()
+      with lock:
+        latencies.append(elapsed)
+        errors[0] += response.status >= 500
+
+  threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+  start = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return latencies, errors[0], time.perf_counter() - start
+
+
+'''
+start_asgi(config)
+    serves the async mode of an app built with config through uvicorn on a
+    free port, returning the server and the port
+'''
+def start_asgi(config):
+  import uvicorn
+  from flaskr.asgi import create_asgi_app
+
+  listener = socket.socket()
+  listener.bind(('127.0.0.1', 0))
+  server = uvicorn.Server(uvicorn.Config(create_asgi_app(config), log_level='error'))
+  threading.Thread(target=server.run, kwargs={'sockets': [listener]}, daemon=True).start()
+  while not server.started:
+    time.sleep(0.01)
+  return server, listener.getsockname()[1]
+
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+'''
+compare(results, baseline, threshold)
+    prints the change of throughput and p95 of every run found in both
+    result sets, and returns the runs slower than threshold (a fraction)
+'''
+def compare(results, baseline, threshold):
+  previous = {(run['rows'], run['transport'], run['endpoint']): run for run in baseline['runs']}
+  regressions = []
+  print('Compared with {} ({})'.format(baseline['meta'].get('revision'), baseline['meta'].get('timestamp')))
+  for run in results['runs']:
+    before = previous.get((run['rows'], run['transport'], run['endpoint']))
+    if before is None:
+      continue
+    throughput = run['throughput'] / before['throughput'] - 1
+    p95 = run['p95_ms'] / before['p95_ms'] - 1
+    regressed = throughput < -threshold or p95 > threshold
+    print('  {:>8} {:<12} {:<20} throughput {:>+7.1%}  p95 {:>+7.1%}{}'.format(
+      run['rows'], run['transport'], run['endpoint'], throughput, p95, '  REGRESSION' if regressed else ''))
+    if regressed:
+      regressions.append(run)
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--rows', default='10000', help='comma separated bank sizes, e.g. 10000,100000,1000000')
+  parser.add_argument('--requests', type=int, default=500, help='measured requests per endpoint')
+  parser.add_argument('--warmup', type=int, default=50, help='unmeasured requests per endpoint')
+  parser.add_argument('--concurrency', type=int, default=8, help='client threads against the HTTP servers')
+  parser.add_argument('--transports', default=','.join(TRANSPORTS), help='test_client, wsgi and asgi')
+  parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+  parser.add_argument('--database-url')
+  parser.add_argument('--config', default='{}', help='JSON object of app config overrides')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  parser.add_argument('--compare', help='results JSON of an earlier run to compare against')
+  parser.add_argument('--threshold', type=float, default=0.1, help='regression threshold, default 10%%')
+  args = parser.parse_args()
+
+  workdir = tempfile.mkdtemp()
+  database_url = args.database_url or 'sqlite:///' + os.path.join(workdir, 'bench.sqlite3')
+  config = dict({'RESPONSE_CACHE_PATH': os.path.join(workdir, 'responses.sqlite3')},
+                **json.loads(args.config), SQLALCHEMY_DATABASE_URI=database_url)
+  transports = args.transports.split(',')
+  endpoints = args.endpoints.split(',')
+
+  results = {
+    'meta': {
+      'timestamp': datetime.now(timezone.utc).isoformat(),
+      'revision': git_revision(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'database': database_url.split(':', 1)[0],
+      'requests': args.requests,
+      'concurrency': args.concurrency,
+      'config': json.loads(args.config),
+    },
+    'runs': []
+  }
+
+  for rows in (int(size) for size in args.rows.split(',')):
+    loader = Flask(__name__)
+    setup_db(loader, database_url)
+    with loader.app_context():
+      create_schema()
+      started = time.perf_counter()
+      category_ids = seed(rows, args.seed)
+      print('Seeded {} questions in {:.1f}s'.format(rows, time.perf_counter() - started))
+
+    app = create_app(config)
+    server = asgi_server = None
+    ports = {}
+    if 'wsgi' in transports:
+      logging.getLogger('werkzeug').setLevel(logging.ERROR)
+      server = make_server('127.0.0.1', 0, app, threaded=True)
+      threading.Thread(target=server.serve_forever, daemon=True).start()
+      ports['wsgi'] = server.server_port
+    if 'asgi' in transports:
+      asgi_server, ports['asgi'] = start_asgi(config)
+
+    for transport in transports:
+      for endpoint in endpoints:
+        warmup = request_mix(endpoint, rows, category_ids, args.warmup, args.seed + 1)
+        measured = request_mix(endpoint, rows, category_ids, args.requests, args.seed)
+        if transport == 'test_client':
+          run_test_client(app, warmup)
+          latencies, errors, seconds = run_test_client(app, measured)
+        else:
+          run_http(ports[transport], warmup, args.concurrency)
+          latencies, errors, seconds = run_http(ports[transport], measured, args.concurrency)
+
+        run = dict(summarize(latencies, errors, seconds), rows=rows, transport=transport, endpoint=endpoint)
+        results['runs'].append(run)
+        print('  {:>8} {:<12} {:<20} {:>8.1f} req/s  p50 {:>7.2f}  p95 {:>7.2f}  p99 {:>7.2f} ms  errors {}'.format(
+          rows, transport, endpoint, run['throughput'], run['p50_ms'], run['p95_ms'], run['p99_ms'], errors))
+
+    if server is not None:
+      server.shutdown()
+    if asgi_server is not None:
+      asgi_server.should_exit = True
+    with app.app_context():
+      db.session.remove()
+      db.get_engine(app).dispose()
+
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(results, output, indent=2)
+    print('Results written to {}'.format(args.output))
+
+  if args.compare:
+    with open(args.compare) as baseline:
+      regressions = compare(results, json.load(baseline), args.threshold)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,81 @@
+'''
+Read-path benchmark: ORM hydration against Core projections.
+
+Seeds a database with synthetic questions (100k by default) and reads
+random keyset pages of the question list three ways: ORM instances turned
+into dicts with Question.format(), flaskr.projections without a compiled
+statement cache, and flaskr.projections with it. SQLite in a temporary file
+is used unless a database URL is given; the questions table of that
+database is emptied first:
+
+    python benchmarks/bench_projections.py --rows 100000
+    python benchmarks/bench_projections.py --database-url postgresql:///trivia_bench
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from models import Question, create_schema, db, setup_db
+from flaskr.projections import QUESTIONS_AFTER, init_projections
+from synthetic import seed
+
+
+def orm_page(after_id, limit):
+  questions = Question.query.filter(Question.id > after_id).order_by(Question.id).limit(limit).all()
+  return [question.format() for question in questions]
+
+
+def projection_page(after_id, limit):
+  return QUESTIONS_AFTER.all(after_id=after_id, limit=limit)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--rows', type=int, default=100000)
+  parser.add_argument('--page-size', type=int, default=100)
+  parser.add_argument('--pages', type=int, default=500)
+  parser.add_argument('--database-url')
+  args = parser.parse_args()
+
+  database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+  app = Flask(__name__)
+  setup_db(app, database_url)
+
+  with app.app_context():
+    create_schema()
+    seed(args.rows)
+    low, high = db.session.query(db.func.min(Question.id), db.func.max(Question.id)).one()
+    generator = random.Random(1)
+    cursors = [generator.randint(low, high - args.page_size) for _ in range(args.pages)]
+
+    readers = [
+      ('ORM + format()', orm_page, True),
+      ('projection', projection_page, False),
+      ('projection, cached SQL', projection_page, True),
+    ]
+    print('{} random pages of {} rows from {} questions ({})'.format(
+      args.pages, args.page_size, args.rows, db.engine.dialect.name))
+    baseline = None
+    for name, read, compiled_cache in readers:
+      app.config['COMPILED_STATEMENT_CACHE'] = compiled_cache
+      init_projections(app)
+
+      def run():
+        for after_id in cursors:
+          read(after_id, args.page_size)
+        db.session.remove()
+
+      seconds = min(timeit.repeat(run, number=1, repeat=3))
+      baseline = baseline or seconds
+      print('  {:<24} {:>9.0f} rows/s  {:>5.1f}x'.format(
+        name, args.pages * args.page_size / seconds, baseline / seconds))
+
+
+if __name__ == '__main__':
+  main()
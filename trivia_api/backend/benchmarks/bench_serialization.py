@@ -0,0 +1,78 @@
+'''
+Serialization and compression benchmark for question listings.
+
+Encodes a /questions-shaped payload of synthetic questions with the
+stdlib encoder Flask's jsonify uses, with the compact stdlib and orjson
+serializers of flaskr.serialization, and reports the bytes on the wire for
+each Content-Encoding the API can negotiate. No database is needed:
+
+    python benchmarks/bench_serialization.py --questions 1000
+'''
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flaskr.serialization import orjson, orjson_dumps, stdlib_dumps
+from flaskr.compression import COMPRESS_LEVEL, brotli
+from synthetic import synthetic_question
+
+
+def synthetic_payload(count, seed=0):
+  generator = random.Random(seed)
+  questions = [dict(synthetic_question(generator, range(1, 7)), id=question_id)
+               for question_id in range(1, count + 1)]
+  return {
+    'success': True,
+    'questions': questions,
+    'total_questions': count,
+    'categories': {'1': 'Science', '2': 'Art', '3': 'Geography',
+                   '4': 'History', '5': 'Entertainment', '6': 'Sports'},
+    'current_category': None
+  }
+
+
+def flask_default_dumps(data):
+  # what flask.jsonify does outside debug mode with JSON_SORT_KEYS on
+  return (json.dumps(data, indent=None, separators=(',', ':'), sort_keys=True) + '\n').encode('utf-8')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--questions', type=int, default=1000)
+  parser.add_argument('--repeat', type=int, default=200)
+  args = parser.parse_args()
+
+  payload = synthetic_payload(args.questions)
+  serializers = [('flask jsonify (stdlib)', flask_default_dumps), ('stdlib compact', stdlib_dumps)]
+  if orjson is not None:
+    serializers.append(('orjson', orjson_dumps))
+  else:
+    print('orjson is not installed, skipping it')
+
+  print('Serialization of {} questions, {} runs'.format(args.questions, args.repeat))
+  baseline = None
+  for name, dumps in serializers:
+    seconds = min(timeit.repeat(lambda: dumps(payload), number=args.repeat, repeat=3)) / args.repeat
+    baseline = baseline or seconds
+    print('  {:<24} {:>9.3f} ms  {:>5.1f}x'.format(name, seconds * 1000, baseline / seconds))
+
+  body = stdlib_dumps(payload)
+  encodings = [('identity', body), ('gzip', gzip.compress(body, COMPRESS_LEVEL))]
+  if brotli is not None:
+    encodings.append(('br', brotli.compress(body, quality=COMPRESS_LEVEL)))
+  else:
+    print('brotli is not installed, skipping br')
+
+  print('Bytes on the wire')
+  for name, data in encodings:
+    print('  {:<24} {:>9d} B  {:>5.1f}%'.format(name, len(data), 100.0 * len(data) / len(body)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,46 @@
+'''
+Synthetic question bank shared by the benchmarks.
+'''
+import random
+
+WORDS = ('what which who where painting soccer world cup river ocean country '
+         'artist invented discovered largest heaviest first title film novel '
+         'element planet history science team player oscar award city palace').split()
+CATEGORIES = ('Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports')
+SEED_BATCH_SIZE = 10000
+
+
+def synthetic_question(generator, category_ids):
+  return {
+    'question': ' '.join(generator.choice(WORDS) for _ in range(generator.randint(6, 16))).capitalize() + '?',
+    'answer': ' '.join(generator.choice(WORDS) for _ in range(generator.randint(1, 3))).title(),
+    'difficulty': generator.randint(1, 5),
+    'category_id': generator.choice(category_ids)
+  }
+
+
+'''
+seed(rows, seed=0)
+    replaces the questions of the bound database with rows synthetic ones,
+    spread over the categories (created when the table is empty); the same
+    seed always gives the same bank. Runs inside an app context; the
+    questions version is bumped like any other write
+'''
+def seed(rows, seed=0):
+  from models import Category, Question, db, mark_changed
+
+  generator = random.Random(seed)
+  db.session.query(Question).delete()
+  if Category.query.count() == 0:
+    db.session.add_all(Category(name) for name in CATEGORIES)
+    db.session.flush()
+  category_ids = [category.id for category in Category.query.order_by(Category.id)]
+
+  for start in range(0, rows, SEED_BATCH_SIZE):
+    db.session.execute(Question.__table__.insert(), [
+      synthetic_question(generator, category_ids) for _ in range(start, min(start + SEED_BATCH_SIZE, rows))])
+  # the bulk delete and inserts skip the ORM events: bump the version and
+  # drop the caches, so the next size is not served this one's responses
+  mark_changed(db.session, Question)
+  db.session.commit()
+  return category_ids
@@ -1,35 +1,79 @@
 # pylint: disable=no-member  
 # pylint: disable=import-error
 import os
-from flask import Flask, request, abort, jsonify
+import click
+from flask import Flask, Response, request, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-from models import setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10
-
-def paginate(request, selection):
-  page = request.args.get('page', 1, type=int)
-  start = (page - 1) * QUESTIONS_PER_PAGE 
-  end = start + QUESTIONS_PER_PAGE 
-  questions = [question.format() for question in selection]
-  current_questions = questions[start:end]
-  return current_questions
+from models import setup_db, create_schema, database_path, replica_paths, pool_stats, use_primary
+from models import Question, Category, db
+from flaskr.pagination import QUESTIONS_PER_PAGE, paginate, paginate_keyset, count_rows
+from flaskr.serialization import init_serialization, jsonify
+from flaskr.compression import init_compression
+from flaskr.metrics import init_metrics, PROMETHEUS_MIMETYPE
+from flaskr.replicas import init_replicas, read_only
+from flaskr.response_cache import init_response_cache
+from flaskr.projections import init_projections, QUESTION_PAGE, QUESTIONS_AFTER
+from flaskr.projections import CATEGORY_QUESTION_PAGE, CATEGORY_QUESTIONS_AFTER, QUESTIONS_BY_ID
+from flaskr.categories import category_snapshot, category_stats
+from flaskr.conditional import conditional
+from flaskr.sampling import question_pool, quiz_category_id, quiz_exclusions, quiz_difficulty_weights
+from flaskr.search import search_backend
+from flaskr.suggest import init_suggest, suggest_index, SUGGESTIONS, MAX_SUGGESTIONS
+from flaskr.bulk import import_questions, parse_json_array, parse_ndjson
+from flaskr.bulk import delete_questions, update_questions, parse_ids, parse_changes
+from flaskr.export import EXPORT_FORMATS, EXPORT_MIMETYPES, export_rows
+from flaskr.quiz_sessions import init_quiz_sessions, shuffled_deck
+
+QUIZ_BATCH_SIZE = 10
+MAX_QUIZ_BATCH_SIZE = 100
+# clients allowed to read /metrics and the /internal/ endpoints
+INTERNAL_ADDRESSES = ('127.0.0.1', '::1')
+# added to every response, next to the Access-Control-Allow-Origin of flask_cors
+CORS_HEADERS = {
+  'Access-Control-Allow-Headers': 'Content-Type,Authorization,true',
+  'Access-Control-Allow-Methods': 'GET,PUT,POST,PATCH,DELETE,OPTIONS'
+}
+ERROR_MESSAGES = {
+  400: 'Bad request :(',
+  404: "Sorry, couldn't find a resource matching your request :(",
+  422: "Sorry, couldn't process your request :(",
+  500: 'Method not allowed'
+}
+
+
+def error_body(status):
+  '''the JSON body of an error response; the async views send the same one'''
+  return {
+    'success': False,
+    'error': status,
+    'message': ERROR_MESSAGES[status]
+  }
 
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
+  if test_config:
+    app.config.from_mapping(test_config)
+  setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path),
+           app.config.get('SQLALCHEMY_REPLICA_URIS', replica_paths))
+  init_replicas(app)
+  init_serialization(app)
+  init_metrics(app)
+  init_compression(app)
+  init_response_cache(app)
+  init_projections(app)
+  init_suggest(app)
+  quiz_sessions = init_quiz_sessions(app)
   cors = CORS(app, resources={r"/*": {"origins": "*"}})
   '''
   @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
   '''
   @app.after_request
   def after_request(response):
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    for name, value in CORS_HEADERS.items():
+      response.headers.add(name, value)
     return response
   '''
   @TODO: Use the after_request decorator to set Access-Control-Allow
@@ -41,41 +85,50 @@ def create_app(test_config=None):
   for all available categories.
   '''
   @app.route("/categories", methods = ["GET"])
+  @conditional(Category)
   def retrieve_categories():
-    records = Category.query.order_by(Category.id).all()
-    categories_list = [record.format() for record in records]
-    
-    categories = {}
-    for category in categories_list:
-      categories['{}'.format(category['id'])] = '{}'.format(category['type'])
+    categories = category_snapshot.get()
     
     return jsonify({
       'success' : True,
       'categories' : categories,
-      'number_of_categories' : len(records)
+      'number_of_categories' : len(categories)
+    })
+
+
+  @app.route('/categories/stats', methods = ['GET'])
+  @conditional(Question, Category)
+  def retrieve_category_stats():
+    stats = category_stats.get()
+    empty = {'total_questions': 0, 'average_difficulty': None, 'difficulty_histogram': {}}
+
+    return jsonify({
+      'success': True,
+      'categories': [dict(stats.get(int(category_id), empty), id=int(category_id), type=category_type)
+                     for category_id, category_type in category_snapshot.get().items()]
     })
   
 
   @app.route("/questions", methods = ["GET"])
+  @conditional(Question, Category, cache=True)
   def retrieve_questions():
-    selection = Question.query.order_by('id').all()
-    current_questions = paginate(request, selection)
-    records = Category.query.order_by(Category.id).all()
-    categories_list = [record.format() for record in records]
-    
-    categories = {}
-    for category in categories_list:
-      categories['{}'.format(category['id'])] = '{}'.format(category['type'])
+    if 'after_id' in request.args:
+      current_questions, next_cursor = paginate_keyset(request, QUESTIONS_AFTER)
+    else:
+      current_questions, next_cursor = paginate(request, QUESTION_PAGE), None
 
     if len(current_questions) == 0:
       abort(404)
 
+    categories = category_snapshot.get()
+
     return jsonify({
       'success': True,
       'questions': current_questions,
-      'total_questions': len(selection),
+      'total_questions': count_rows(Question.query),
       'categories': categories,
-      'current_category': None
+      'current_category': None,
+      'next_cursor': next_cursor
     })
       
 
@@ -92,6 +145,113 @@ def create_app(test_config=None):
   Clicking on the page numbers should update the questions. 
   '''
 
+  @app.route('/questions/suggest', methods = ['GET'])
+  def suggest_questions():
+    prefix = request.args.get('prefix', '')
+    limit = request.args.get('limit', SUGGESTIONS, type=int)
+    suggestions = suggest_index.suggest(prefix, max(1, min(limit, MAX_SUGGESTIONS)))
+
+    return jsonify({
+      'success': True,
+      'prefix': prefix,
+      'suggestions': [{'id': question_id, 'question': question}
+                      for question_id, question in suggestions]
+    })
+
+
+  @app.route('/questions/export', methods = ['GET'])
+  def export_questions():
+    export_format = request.args.get('format', 'ndjson')
+    category_id = request.args.get('category', None, type=int)
+    if export_format not in EXPORT_FORMATS:
+      abort(400)
+
+    chunks = EXPORT_FORMATS[export_format](export_rows(category_id))
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=questions.{}'.format(export_format)
+    return response
+
+
+  @app.route('/questions/bulk', methods = ['POST'])
+  def bulk_create_questions():
+    try:
+      if request.mimetype == 'application/x-ndjson':
+        rows = parse_ndjson(request.get_data(as_text=True))
+      else:
+        rows = parse_json_array(request.get_json(force=True))
+    except ValueError:
+      abort(422)
+
+    inserted, errors = import_questions(rows)
+
+    return jsonify({
+      'success': True,
+      'inserted': inserted,
+      'errors': errors,
+      'total_questions': count_rows(Question.query, estimate=False)
+    })
+
+
+  @app.route('/questions', methods = ['DELETE'])
+  def batch_delete_questions():
+    body = request.get_json()
+
+    try:
+      ids = parse_ids(body.get('ids'))
+    except (AttributeError, ValueError):
+      abort(422)
+
+    deleted = delete_questions(ids)
+    if len(deleted) == 0:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'deleted_questions': deleted,
+      'total_questions': count_rows(Question.query, estimate=False)
+    })
+
+
+  @app.route('/questions', methods = ['PATCH'])
+  def batch_update_questions():
+    body = request.get_json()
+
+    try:
+      ids = parse_ids(body.get('ids'))
+      values = parse_changes(body.get('changes'))
+    except (AttributeError, ValueError):
+      abort(422)
+
+    updated = update_questions(ids, values)
+    if len(updated) == 0:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'updated_questions': updated
+    })
+
+
+  @app.cli.command('init-db')
+  def init_db_command():
+    '''Create the tables and indexes missing from the database.'''
+    create_schema()
+    click.echo('Database schema is up to date')
+
+
+  @app.cli.command('import-questions')
+  @click.argument('source', type=click.File('r'))
+  def import_questions_command(source):
+    '''Bulk import questions from a JSON array or NDJSON file.'''
+    text = source.read()
+    rows = parse_json_array(text) if text.lstrip().startswith('[') else parse_ndjson(text)
+    inserted, errors = import_questions(rows)
+
+    for error in errors:
+      click.echo('row {row}: {error}'.format(**error), err=True)
+    click.echo('Imported {} questions, rejected {}'.format(inserted, len(errors)))
+
+
   @app.route('/questions/<int:question_id>', methods = ['DELETE'])
   def delete_question(question_id):
     question = Question.query.filter(Question.id == question_id).one_or_none()
@@ -101,12 +261,11 @@ def create_app(test_config=None):
 
     try:
       question.delete()
-      selection = Question.query.order_by('id').all()
 
       return jsonify({
         'success': True,
         'deleted_question': question_id,
-        'total_questions': len(selection)
+        'total_questions': count_rows(Question.query, estimate=False)
       })
     except: 
       abort(422)
@@ -130,12 +289,11 @@ def create_app(test_config=None):
       new_question = Question(question = question, answer = answer,
                               difficulty = difficulty, category_id = category_id)
       new_question.insert()
-      selection = Question.query.order_by('id').all()
 
       return jsonify({
         'success': True,
         'posted': new_question.format(),
-        'total_questions': len(selection)
+        'total_questions': count_rows(Question.query, estimate=False)
       })
   
     except:
@@ -151,19 +309,21 @@ def create_app(test_config=None):
   of the questions list in the "List" tab.  
   '''
   @app.route('/search_questions', methods = ['POST'])
+  @read_only
   def search_questions():
     body = request.get_json()
     
     try:
-      search_term = body.get('search_term')
-      search = '%{}%'.format(search_term)
-      selection = Question.query.filter(Question.question.ilike(search)).order_by('id').all()
-      current_questions = paginate(request, selection)
+      search_term = body.get('search_term') or ''
+      mode = body.get('mode') or 'fulltext'
+      page = max(request.args.get('page', 1, type=int), 1)
+      current_questions, total_questions = search_backend(app, mode).search(
+        search_term, (page - 1) * QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE)
 
       return jsonify({
         'success': True,
         'questions': current_questions,
-        'total_questions': len(selection),
+        'total_questions': total_questions,
         'current_category': None
       })
     
@@ -181,9 +341,14 @@ def create_app(test_config=None):
   Try using the word "title" to start. 
   '''
   @app.route("/categories/<int:category_id>/questions", methods = ['GET'])
+  @conditional(Question, cache=True)
   def retrieve_questions_by_category_id(category_id):
-    selection = Question.query.filter(Question.category_id == category_id).order_by('id').all()
-    current_questions = paginate(request, selection)
+    if 'after_id' in request.args:
+      current_questions, next_cursor = paginate_keyset(
+        request, CATEGORY_QUESTIONS_AFTER, category_id=category_id)
+    else:
+      current_questions, next_cursor = paginate(
+        request, CATEGORY_QUESTION_PAGE, category_id=category_id), None
     
     if len(current_questions) == 0:
       abort(404)
@@ -191,8 +356,9 @@ def create_app(test_config=None):
     return jsonify({
       'success': True,
       'questions': current_questions,
-      'total_questions': len(selection),
-      'current_category': category_id
+      'total_questions': count_rows(Question.query.filter(Question.category_id == category_id)),
+      'current_category': category_id,
+      'next_cursor': next_cursor
     })
 
   
@@ -205,37 +371,30 @@ def create_app(test_config=None):
   category to be shown. 
   '''
   @app.route('/quizzes', methods = ['POST'])
+  @read_only
   def quiz():
     body = request.get_json()
     
     try:
-      previous_questions = body.get('previous_questions')
+      previous_questions = quiz_exclusions(body.get('previous_questions'))
       quiz_category = body.get('quiz_category', None)
+      category_id = quiz_category_id(quiz_category)
+      weights = quiz_difficulty_weights(body, category_id, len(previous_questions))
+    except (AttributeError, KeyError, TypeError, ValueError):
+      abort(422)
 
-      if quiz_category:
-        questions = Question.query.filter(Question.category_id == quiz_category).all()
-      else:
-        questions = Question.query.all()
+    if len(question_pool.ids(category_id)) == 0:
+      abort(404)
 
-      if len(questions) == 0:
-        abort(404)
-      
-      questions_list = [question.format() for question in questions]
+    questions = question_pool.draw(category_id, 1, previous_questions, weights)
+    question = questions[0] if questions else None
 
-      for previous_question in previous_questions:
-        for question in questions_list:
-          if previous_question['id'] == question['id']:
-            questions_list.remove(question)
-      
-      random_question = random.choice(questions_list)
-        
-      return jsonify({
-          'success': True,
-          'question': random_question,
-          'play_category': quiz_category
-      })
-    except:
-      abort(422)
+    return jsonify({
+        'success': True,
+        'question': question,
+        'play_category': quiz_category,
+        'quiz_exhausted': question is None
+    })
 
 
   '''
@@ -249,42 +408,136 @@ def create_app(test_config=None):
   one question at a time is displayed, the user is allowed to answer
   and shown whether they were correct or not. 
   '''
+  @app.route('/quizzes/batch', methods = ['POST'])
+  @read_only
+  def quiz_batch():
+    body = request.get_json()
+
+    try:
+      previous_questions = quiz_exclusions(body.get('previous_questions'))
+      quiz_category = body.get('quiz_category', None)
+      category_id = quiz_category_id(quiz_category)
+      count = int(body.get('count', QUIZ_BATCH_SIZE))
+      weights = quiz_difficulty_weights(body, category_id, len(previous_questions))
+    except (AttributeError, KeyError, TypeError, ValueError):
+      abort(422)
+
+    if count < 1 or count > MAX_QUIZ_BATCH_SIZE:
+      abort(422)
+    if len(question_pool.ids(category_id)) == 0:
+      abort(404)
+
+    questions = question_pool.draw(category_id, count, previous_questions, weights)
+
+    return jsonify({
+      'success': True,
+      'questions': questions,
+      'play_category': quiz_category,
+      'quiz_exhausted': len(questions) < count
+    })
+
+
+  @app.route('/quizzes/sessions', methods = ['POST'])
+  @read_only
+  def create_quiz_session():
+    body = request.get_json(silent=True) or {}
+
+    try:
+      quiz_category = body.get('quiz_category', None)
+      category_id = quiz_category_id(quiz_category)
+    except (AttributeError, KeyError, TypeError, ValueError):
+      abort(422)
+
+    ids = question_pool.ids(category_id)
+    if len(ids) == 0:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'session_id': quiz_sessions.create(shuffled_deck(ids)),
+      'play_category': quiz_category,
+      'total_questions': len(ids)
+    })
+
+
+  @app.route('/quizzes/sessions/<session_id>/next', methods = ['POST'])
+  @read_only
+  def next_quiz_question(session_id):
+    question = None
+    try:
+      # skip ids whose question was deleted after the deck was shuffled
+      while question is None:
+        question_id = quiz_sessions.pop(session_id)
+        if question_id is None:
+          break
+        question = next(iter(QUESTIONS_BY_ID.all(ids=[question_id])), None)
+    except KeyError:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'question': question,
+      'quiz_exhausted': question is None
+    })
+
+
+  @app.route('/quizzes/sessions/<session_id>', methods = ['DELETE'])
+  def delete_quiz_session(session_id):
+    quiz_sessions.delete(session_id)
+
+    return jsonify({
+      'success': True,
+      'deleted_session': session_id
+    })
+
+
+  def require_internal():
+    if request.remote_addr not in app.config.get('INTERNAL_ADDRESSES', INTERNAL_ADDRESSES):
+      abort(404)
+
+
+  @app.route('/metrics', methods = ['GET'])
+  def retrieve_metrics():
+    require_internal()
+    return Response(app.extensions['metrics'].render(), content_type=PROMETHEUS_MIMETYPE)
+
+
+  @app.route('/internal/pool', methods = ['GET'])
+  def retrieve_pool_stats():
+    require_internal()
+    stats = pool_stats()
+    if db.engine.dialect.name == 'postgresql':
+      with use_primary():
+        stats['database_max_connections'] = int(db.session.execute('SHOW max_connections').scalar())
+    if app.extensions['replicas'] is not None:
+      stats['replicas'] = app.extensions['replicas'].stats()
+
+    return jsonify({
+      'success': True,
+      'pool': stats
+    })
+
+
   @app.errorhandler(400)
   def bad_request(error):
-        return jsonify({
-            "success": False, 
-            "error": 400,
-            "message": "Bad request :("
-        }), 400
+        return jsonify(error_body(400)), 400
 
 
   @app.errorhandler(404)
   def not_found(error):
-        return jsonify({
-            "success": False, 
-            "error": 404,
-            "message": "Sorry, couldn't find a resource matching your request :("
-        }), 404
+        return jsonify(error_body(404)), 404
 
 
   @app.errorhandler(422)
   def unprocessable(error):
-        return jsonify({
-            "success": False, 
-            "error": 422,
-            "message": "Sorry, couldn't process your request :("
-        }), 422
+        return jsonify(error_body(422)), 422
 
     
   @app.errorhandler(500)
   def not_allowed(error):
-        return jsonify({
-            "success": False, 
-            "error": 500,
-            "message": "Method not allowed"
-        }), 500
+        return jsonify(error_body(500)), 500
 
-    """
+  """
     @app.errorhandler(404)
     def not_found(error=None):
         message = {
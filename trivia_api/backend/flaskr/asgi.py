@@ -0,0 +1,471 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+'''
+Async (ASGI) serving mode.
+
+The read endpoints run as coroutines over an async database driver
+(asyncpg on postgres, aiosqlite on SQLite, through the databases package),
+so a worker waiting on a slow query keeps serving other requests. Every
+other route, and the reads without an async version here, fall through to
+the Flask app of create_app(), which runs on a thread pool. Responses keep
+the JSON, status codes, ETags, response cache entries and metrics of the
+Flask handlers:
+
+    uvicorn --factory flaskr.asgi:create_asgi_app --workers 4
+'''
+import contextlib
+import contextvars
+import json
+import time
+from array import array
+import databases
+from a2wsgi import WSGIMiddleware
+from flask import abort
+from sqlalchemy import and_, func, select, text
+from sqlalchemy.engine.url import make_url
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from models import Category, DataVersion, Question, on_commit
+from flaskr import CORS_HEADERS, ERROR_MESSAGES, create_app, error_body
+from flaskr.categories import category_snapshot, category_stats
+from flaskr.compression import compress_data, compression_settings
+from flaskr.conditional import response_key, versions_etag
+from flaskr.metrics import timing_headers
+from flaskr.pagination import QUESTIONS_PER_PAGE, COUNT_ESTIMATE, COUNT_ESTIMATE_THRESHOLD
+from flaskr.pagination import keyset_page, keyset_params, page_params
+from flaskr.projections import QUESTION_PAGE, QUESTIONS_AFTER, CATEGORY_QUESTION_PAGE, CATEGORY_QUESTIONS_AFTER
+from flaskr.projections import CATEGORIES, CATEGORY_DIFFICULTY_COUNTS, question_columns, questions
+from flaskr.response_cache import cache_get, cache_set
+from flaskr.sampling import QuestionPool, quiz_category_id, quiz_exclusions, quiz_difficulty_weights
+from flaskr.search import SEARCH_BACKENDS, SEARCH_CONFIG, TRIGRAM_THRESHOLD, TRIGRAM_MATCH
+from flaskr.search import FULLTEXT_PAGE, TRIGRAM_PAGE, question_document, search_backend_name, tokenize
+
+ASYNC_POOL_SIZE = 20
+# threads running the Flask app for the routes served synchronously
+WSGI_WORKERS = 10
+JSON_MIMETYPE = 'application/json'
+
+VERSIONS = select([DataVersion.name, DataVersion.version])
+SET_TRIGRAM_THRESHOLD = text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)")
+
+# [statements, seconds] of the SQL run by the current request
+_sql_accounting = contextvars.ContextVar('sql_accounting', default=None)
+# pool entries loaded for the current request, see AsyncQuestionPool
+_loaded_pool_entries = contextvars.ContextVar('loaded_pool_entries', default=None)
+
+
+'''
+async_database_url(database_uri)
+    the databases URL of a SQLAlchemy URI: the driver is dropped, as the
+    databases package picks asyncpg or aiosqlite from the dialect
+'''
+def async_database_url(database_uri):
+  url = make_url(database_uri)
+  url.drivername = url.get_backend_name()
+  return str(url)
+
+
+'''
+AsyncReads(url, **options)
+    the async counterpart of db.session for the read endpoints: a pool of
+    connections of the databases package running the Core statements of
+    flaskr.projections with their bindparams filled in. Rows come back as
+    dicts (all) or tuples (rows), and the statements and time spent in them
+    are counted for the request's metrics
+'''
+class AsyncReads:
+  def __init__(self, url, **options):
+    self.database = databases.Database(url, **options)
+    self.dialect = make_url(url).get_backend_name()
+
+  async def execute(self, statement, **params):
+    started = time.perf_counter()
+    rows = await self.database.fetch_all(statement.params(**params) if params else statement)
+    accounting = _sql_accounting.get()
+    if accounting is not None:
+      accounting[0] += 1
+      accounting[1] += time.perf_counter() - started
+    return rows
+
+  async def all(self, statement, **params):
+    return [dict(row.items()) for row in await self.execute(statement, **params)]
+
+  async def rows(self, statement, **params):
+    return [tuple(row.values()) for row in await self.execute(statement, **params)]
+
+  async def scalar(self, statement, **params):
+    rows = await self.rows(statement, **params)
+    return rows[0][0] if rows else None
+
+  async def versions(self):
+    return dict(await self.rows(VERSIONS))
+
+  async def count_questions(self, *criteria):
+    '''count_rows() of the questions matching criteria'''
+    if not criteria and self.dialect == 'postgresql':
+      estimate = await self.scalar(COUNT_ESTIMATE, table=Question.__tablename__)
+      if estimate is not None and estimate > COUNT_ESTIMATE_THRESHOLD:
+        return estimate
+
+    statement = select([func.count(questions.c.id)])
+    if criteria:
+      statement = statement.where(and_(*criteria))
+    return await self.scalar(statement)
+
+
+'''
+AsyncQuestionPool
+    QuestionPool whose arrays are read with await load(reads, category_id,
+    weighted) before a draw. Loaded entries are also pinned to the request,
+    so a write committed by a Flask thread while the request runs cannot
+    take them away between the load and the draw
+'''
+class AsyncQuestionPool(QuestionPool):
+  async def load(self, reads, category_id=None, weighted=False):
+    entries = self._buckets if weighted else self._ids
+    entry = entries.get(category_id)
+    if entry is None or time.monotonic() - entry[0] >= self.max_age:
+      columns = [questions.c.id, questions.c.difficulty] if weighted else [questions.c.id]
+      selection = select(columns)
+      if category_id is not None:
+        selection = selection.where(questions.c.category_id == category_id)
+      rows = await reads.rows(selection)
+      if weighted:
+        buckets = {}
+        for question_id, difficulty in rows:
+          buckets.setdefault(difficulty, array('l')).append(question_id)
+        entry = (time.monotonic(), buckets, {})
+      else:
+        entry = (time.monotonic(), array('l', (row[0] for row in rows)))
+      with self._lock:
+        (self._buckets if weighted else self._ids)[category_id] = entry
+
+    pinned = _loaded_pool_entries.get()
+    if pinned is None:
+      pinned = {}
+      _loaded_pool_entries.set(pinned)
+    pinned[weighted, category_id] = entry
+
+  def ids(self, category_id=None):
+    return _loaded_pool_entries.get()[False, category_id][1]
+
+  def _bucket_entry(self, category_id):
+    return _loaded_pool_entries.get()[True, category_id]
+
+  async def fetch(self, reads, category_id=None, count=1, exclude=frozenset(), weights=None):
+    '''draw() over reads, once the ids (and buckets for weights) are loaded'''
+    ids = self._pick(category_id, count, exclude, weights)
+    drawn = await self._fetch_questions(reads, ids)
+    if len(drawn) < len(ids):
+      self.discard(category_id)
+      await self.load(reads, category_id, weighted=bool(weights))
+      exclude = set(exclude).union(ids)
+      ids = self._pick(category_id, len(ids) - len(drawn), exclude, weights)
+      drawn.extend(await self._fetch_questions(reads, ids))
+    return drawn
+
+  @staticmethod
+  async def _fetch_questions(reads, ids):
+    if len(ids) == 0:
+      return []
+    # expanding bindparams are not supported by the databases package
+    rows = await reads.all(select(question_columns).where(questions.c.id.in_(ids)))
+    questions_by_id = {question['id']: question for question in rows}
+    return [questions_by_id[question_id] for question_id in ids if question_id in questions_by_id]
+
+
+async_question_pool = AsyncQuestionPool()
+
+on_commit(Question, async_question_pool.invalidate)
+
+
+def full_path(request):
+  # the request.full_path of flask, so both modes share response cache keys
+  return '{}?{}'.format(request.scope['path'], request.scope['query_string'].decode('utf-8', 'replace'))
+
+
+'''
+request_json(request)
+    the JSON body like flask's request.get_json(): None unless the request
+    is sent as JSON, and a 400 when the body does not parse
+'''
+async def request_json(request):
+  mimetype = request.headers.get('content-type', '').split(';')[0].strip().lower()
+  if not (mimetype == JSON_MIMETYPE or (mimetype.startswith('application/') and mimetype.endswith('+json'))):
+    return None
+  try:
+    return json.loads(await request.body())
+  except ValueError:
+    abort(400)
+
+
+'''
+create_asgi_app(test_config=None)
+    the ASGI application of the async serving mode, wrapping the Flask app
+    built with the same config. ASYNC_DATABASE_URI overrides the database
+    URL derived from SQLALCHEMY_DATABASE_URI, and ASYNC_POOL_SIZE caps the
+    async connections of a postgres pool
+'''
+def create_asgi_app(test_config=None):
+  app = create_app(test_config)
+  config = app.config
+  database_uri = config['SQLALCHEMY_DATABASE_URI']
+  url = config.get('ASYNC_DATABASE_URI') or async_database_url(database_uri)
+  options = {}
+  if make_url(url).get_backend_name() == 'postgresql':
+    options = {'min_size': 1, 'max_size': config.get('ASYNC_POOL_SIZE', ASYNC_POOL_SIZE)}
+  reads = AsyncReads(url, **options)
+
+  dumps = app.extensions['json_dumps']
+  metrics = app.extensions['metrics']
+  response_cache = app.extensions.get('response_cache')
+  encodings, min_size, level = compression_settings(config)
+  server_timing = config.get('SERVER_TIMING', False)
+  routes = []
+
+  def encode(request, status, body, headers):
+    # flaskr.compression for buffered bodies
+    if status != 200 or not encodings:
+      return body
+    headers['Vary'] = 'Accept-Encoding' if 'Vary' not in headers else headers['Vary'] + ', Accept-Encoding'
+    encoding = parse_accept_header(request.headers.get('accept-encoding')).best_match(encodings)
+    data = compress_data(body, encoding, level, min_size) if encoding is not None else None
+    if data is None:
+      return body
+    headers['Content-Encoding'] = encoding
+    if 'ETag' in headers:
+      headers['ETag'] = 'W/' + headers['ETag']
+    return data
+
+  '''
+  route(path, rule, method, *models, cache=False)
+      registers an async view at the starlette path. The view returns the
+      JSON data of a successful response or aborts like a flask view; the
+      wrapper adds what the Flask app does around its views: conditional()
+      on models, the error bodies, CORS, compression and metrics under the
+      flask rule
+  '''
+  def route(path, rule, method, *models, cache=False):
+    def decorator(view):
+      async def endpoint(request):
+        started = time.perf_counter()
+        accounting = [0, 0.0]
+        _sql_accounting.set(accounting)
+        headers = {}
+        body = b''
+        try:
+          etag = None
+          if models:
+            request.state.versions = await reads.versions()
+            etag = versions_etag(request.state.versions, *models)
+            headers['ETag'] = quote_etag(etag)
+
+          key = None
+          if cache and response_cache is not None:
+            key = response_key(database_uri, full_path(request), etag)
+
+          if etag is not None and parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+            status = 304
+          else:
+            status = 200
+            # the cache may be a network round trip away
+            body = await run_in_threadpool(cache_get, response_cache, key) if key else None
+            if body is None:
+              body = dumps(await view(request, **request.path_params))
+              if key:
+                await run_in_threadpool(cache_set, response_cache, key, body)
+        except HTTPException as error:
+          status = error.code if error.code in ERROR_MESSAGES else 500
+          body = dumps(error_body(status))
+          headers.pop('ETag', None)
+        except Exception:
+          app.logger.exception('Exception on %s [%s]', request.url.path, request.method)
+          status = 500
+          body = dumps(error_body(status))
+          headers.pop('ETag', None)
+
+        origin = request.headers.get('origin')
+        headers['Access-Control-Allow-Origin'] = origin or '*'
+        if origin:
+          headers['Vary'] = 'Origin'
+        headers.update(CORS_HEADERS)
+        if status != 304:
+          body = encode(request, status, body, headers)
+
+        seconds = time.perf_counter() - started
+        metrics.record(rule, method, status, seconds, accounting[0], accounting[1], len(body))
+        if server_timing:
+          headers.update(timing_headers(seconds, accounting[0], accounting[1]))
+        return Response(body, status, headers, media_type=None if status == 304 else JSON_MIMETYPE)
+
+      routes.append(Route(path, endpoint, methods=[method]))
+      return view
+    return decorator
+
+  async def load_categories(request):
+    version = request.state.versions.get('categories', 0)
+    categories = category_snapshot.cached(version)
+    if categories is None:
+      categories = category_snapshot.store(version, await reads.rows(CATEGORIES.statement))
+    return categories
+
+  async def read_page(args, keyset, projection, **params):
+    if 'after_id' in args:
+      bounds, limit = keyset_params(args)
+      return keyset_page(await reads.all(keyset.statement, **bounds, **params), limit)
+    bounds = page_params(args)
+    return (await reads.all(projection.statement, **bounds, **params) if bounds else []), None
+
+  @route('/categories', '/categories', 'GET', Category)
+  async def retrieve_categories(request):
+    categories = await load_categories(request)
+
+    return {
+      'success': True,
+      'categories': categories,
+      'number_of_categories': len(categories)
+    }
+
+  @route('/categories/stats', '/categories/stats', 'GET', Question, Category)
+  async def retrieve_category_stats(request):
+    version = request.state.versions.get('questions', 0)
+    stats = category_stats.cached(version)
+    if stats is None:
+      stats = category_stats.store(version, await reads.rows(CATEGORY_DIFFICULTY_COUNTS.statement))
+    empty = {'total_questions': 0, 'average_difficulty': None, 'difficulty_histogram': {}}
+
+    return {
+      'success': True,
+      'categories': [dict(stats.get(int(category_id), empty), id=int(category_id), type=category_type)
+                     for category_id, category_type in (await load_categories(request)).items()]
+    }
+
+  @route('/questions', '/questions', 'GET', Question, Category, cache=True)
+  async def retrieve_questions(request):
+    args = MultiDict(request.query_params.multi_items())
+    current_questions, next_cursor = await read_page(args, QUESTIONS_AFTER, QUESTION_PAGE)
+
+    if len(current_questions) == 0:
+      abort(404)
+
+    return {
+      'success': True,
+      'questions': current_questions,
+      'total_questions': await reads.count_questions(),
+      'categories': await load_categories(request),
+      'current_category': None,
+      'next_cursor': next_cursor
+    }
+
+  @route('/categories/{category_id:int}/questions', '/categories/<int:category_id>/questions',
+         'GET', Question, cache=True)
+  async def retrieve_questions_by_category_id(request, category_id):
+    args = MultiDict(request.query_params.multi_items())
+    current_questions, next_cursor = await read_page(
+      args, CATEGORY_QUESTIONS_AFTER, CATEGORY_QUESTION_PAGE, category_id=category_id)
+
+    if len(current_questions) == 0:
+      abort(404)
+
+    return {
+      'success': True,
+      'questions': current_questions,
+      'total_questions': await reads.count_questions(questions.c.category_id == category_id),
+      'current_category': category_id,
+      'next_cursor': next_cursor
+    }
+
+  async def search(search_term, mode, offset, limit):
+    # FullTextSearch and TrigramSearch
+    if mode not in SEARCH_BACKENDS:
+      raise KeyError(mode)
+    if not tokenize(search_term):
+      return (await reads.all(QUESTION_PAGE.statement, offset=offset, limit=limit),
+              await reads.count_questions())
+
+    if mode == 'fulltext':
+      match = question_document().op('@@')(func.plainto_tsquery(SEARCH_CONFIG, search_term))
+      return (await reads.all(FULLTEXT_PAGE.statement, search_term=search_term, offset=offset, limit=limit),
+              await reads.count_questions(match))
+
+    async with reads.database.transaction():
+      await reads.execute(SET_TRIGRAM_THRESHOLD,
+                          threshold=str(config.get('TRIGRAM_THRESHOLD', TRIGRAM_THRESHOLD)))
+      return (await reads.all(TRIGRAM_PAGE.statement, search_term=search_term, offset=offset, limit=limit),
+              await reads.count_questions(text(TRIGRAM_MATCH).bindparams(search_term=search_term)))
+
+  # the in-memory search indexes load through db.session, so other
+  # backends keep being served by the Flask app
+  if search_backend_name(app) == 'postgresql':
+    @route('/search_questions', '/search_questions', 'POST')
+    async def search_questions(request):
+      body = await request_json(request)
+
+      try:
+        search_term = body.get('search_term') or ''
+        mode = body.get('mode') or 'fulltext'
+        page = max(MultiDict(request.query_params.multi_items()).get('page', 1, type=int), 1)
+        current_questions, total_questions = await search(
+          search_term, mode, (page - 1) * QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE)
+
+        return {
+          'success': True,
+          'questions': current_questions,
+          'total_questions': total_questions,
+          'current_category': None
+        }
+
+      except Exception:
+        abort(422)
+
+  @route('/quizzes', '/quizzes', 'POST')
+  async def quiz(request):
+    body = await request_json(request)
+
+    try:
+      previous_questions = quiz_exclusions(body.get('previous_questions'))
+      quiz_category = body.get('quiz_category', None)
+      category_id = quiz_category_id(quiz_category)
+      weighted = body.get('difficulty_ramp') or body.get('difficulty_weights') is not None or \
+        config.get('QUIZ_DIFFICULTY_WEIGHTS') is not None
+    except (AttributeError, KeyError, TypeError, ValueError):
+      abort(422)
+
+    await async_question_pool.load(reads, category_id)
+    if weighted:
+      await async_question_pool.load(reads, category_id, weighted=True)
+    try:
+      # no await while the app context is pushed: it is shared by the event loop
+      with app.app_context():
+        weights = quiz_difficulty_weights(body, category_id, len(previous_questions), async_question_pool)
+    except (AttributeError, KeyError, TypeError, ValueError):
+      abort(422)
+
+    if len(async_question_pool.ids(category_id)) == 0:
+      abort(404)
+
+    questions = await async_question_pool.fetch(reads, category_id, 1, previous_questions, weights)
+    question = questions[0] if questions else None
+
+    return {
+        'success': True,
+        'question': question,
+        'play_category': quiz_category,
+        'quiz_exhausted': question is None
+    }
+
+  @contextlib.asynccontextmanager
+  async def lifespan(_):
+    await reads.database.connect()
+    yield
+    await reads.database.disconnect()
+
+  routes.append(Mount('/', WSGIMiddleware(app, workers=config.get('WSGI_WORKERS', WSGI_WORKERS))))
+  asgi_app = Starlette(routes=routes, lifespan=lifespan)
+  asgi_app.state.flask_app = app
+  return asgi_app
@@ -0,0 +1,218 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import csv
+import io
+import json
+from sqlalchemy import Integer, any_, bindparam, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import SQLAlchemyError
+from models import Question, db, mark_changed
+from flaskr.categories import category_snapshot
+
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_COLUMNS = ('question', 'answer', 'difficulty', 'category_id')
+MAX_BATCH_IDS = 1000
+
+'''
+parse_ndjson(text) / parse_json_array(text)
+    return (row number, question dict) pairs; a line that is not valid JSON
+    comes back as the error message in place of the dict
+'''
+def parse_ndjson(text):
+  rows = []
+  for number, line in enumerate(text.splitlines(), 1):
+    if not line.strip():
+      continue
+    try:
+      rows.append((number, json.loads(line)))
+    except ValueError as error:
+      rows.append((number, 'invalid JSON: {}'.format(error)))
+  return rows
+
+
+def parse_json_array(payload):
+  if isinstance(payload, str):
+    payload = json.loads(payload)
+  if not isinstance(payload, list):
+    raise ValueError('expected a JSON array of questions')
+  return list(enumerate(payload, 1))
+
+
+'''
+validate_rows(rows)
+    splits parsed rows into insertable column dicts and per-row errors; the
+    category ids of the whole batch are checked against a single lookup
+'''
+def validate_rows(rows):
+  categories = category_snapshot.get()
+  valid = []
+  errors = []
+
+  for number, row in rows:
+    if not isinstance(row, dict):
+      errors.append({'row': number, 'error': row if isinstance(row, str) else 'expected an object'})
+      continue
+
+    question = row.get('question')
+    answer = row.get('answer')
+    difficulty = row.get('difficulty')
+    category_id = row.get('category', row.get('category_id'))
+
+    if not isinstance(question, str) or not question.strip():
+      error = 'question is required'
+    elif not isinstance(answer, str) or not answer.strip():
+      error = 'answer is required'
+    elif not isinstance(difficulty, int) or isinstance(difficulty, bool):
+      error = 'difficulty must be an integer'
+    elif '{}'.format(category_id) not in categories:
+      error = 'unknown category {}'.format(category_id)
+    else:
+      valid.append((number, {'question': question, 'answer': answer,
+                             'difficulty': difficulty, 'category_id': int(category_id)}))
+      continue
+    errors.append({'row': number, 'error': error})
+
+  return valid, errors
+
+
+def _copy_chunk(values):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  for row in values:
+    writer.writerow([row[column] for column in IMPORT_COLUMNS])
+  buffer.seek(0)
+
+  cursor = db.session.connection().connection.cursor()
+  try:
+    cursor.copy_expert(
+      'COPY questions ({}) FROM STDIN WITH (FORMAT csv)'.format(', '.join(IMPORT_COLUMNS)),
+      buffer)
+  finally:
+    cursor.close()
+
+
+def _insert_chunk(values):
+  if db.session.connection().dialect.name == 'postgresql':
+    _copy_chunk(values)
+  else:
+    db.session.execute(Question.__table__.insert(), values)
+
+
+'''
+import_questions(rows)
+    validates and inserts parsed rows in chunks of IMPORT_CHUNK_SIZE, with
+    COPY on postgres and executemany elsewhere, inside one transaction.
+    A chunk the database rejects is rolled back to its savepoint and
+    retried row by row, so only the offending rows are reported. Returns
+    the number of inserted rows and the list of row errors
+'''
+def import_questions(rows):
+  valid, errors = validate_rows(rows)
+  inserted = 0
+  # COPY runs on the raw DBAPI cursor, whose errors SQLAlchemy does not wrap
+  database_errors = (SQLAlchemyError, db.session.connection().dialect.dbapi.Error)
+
+  try:
+    for start in range(0, len(valid), IMPORT_CHUNK_SIZE):
+      chunk = valid[start:start + IMPORT_CHUNK_SIZE]
+      try:
+        with db.session.begin_nested():
+          _insert_chunk([values for _, values in chunk])
+        inserted += len(chunk)
+        continue
+      except database_errors:
+        pass
+
+      for number, values in chunk:
+        try:
+          with db.session.begin_nested():
+            db.session.execute(Question.__table__.insert(), [values])
+          inserted += 1
+        except database_errors as error:
+          errors.append({'row': number, 'error': str(getattr(error, 'orig', None) or error).strip()})
+
+    if inserted:
+      mark_changed(db.session, Question)
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+
+  errors.sort(key=lambda error: error['row'])
+  return inserted, errors
+
+
+'''
+parse_ids(ids)
+    validates the id list of a batch request, raising ValueError on
+    anything but 1 to MAX_BATCH_IDS integers
+'''
+def parse_ids(ids):
+  if not isinstance(ids, list) or not 0 < len(ids) <= MAX_BATCH_IDS:
+    raise ValueError('expected a list of 1 to {} ids'.format(MAX_BATCH_IDS))
+  if any(not isinstance(question_id, int) or isinstance(question_id, bool) for question_id in ids):
+    raise ValueError('ids must be integers')
+  return sorted(set(ids))
+
+
+'''
+parse_changes(changes)
+    validates the column values of a batch update: difficulty and category
+'''
+def parse_changes(changes):
+  if not isinstance(changes, dict) or not changes:
+    raise ValueError('expected the values to change')
+
+  values = {}
+  for key, value in changes.items():
+    if key == 'difficulty' and isinstance(value, int) and not isinstance(value, bool):
+      values['difficulty'] = value
+    elif key in ('category', 'category_id') and '{}'.format(value) in category_snapshot.get():
+      values['category_id'] = int(value)
+    else:
+      raise ValueError('cannot set {} to {}'.format(key, value))
+  return values
+
+
+def _matching(ids, connection):
+  if connection.dialect.name == 'postgresql':
+    return Question.id == any_(bindparam('ids', ids, type_=ARRAY(Integer)))
+  return Question.id.in_(ids)
+
+
+def _run_returning(statement, ids):
+  connection = db.session.connection()
+  if connection.dialect.name == 'postgresql':
+    result = connection.execute(statement.where(_matching(ids, connection)).returning(Question.id))
+    return sorted(row[0] for row in result)
+
+  # no RETURNING before SQLite 3.35: read the matching ids in the same transaction
+  found = sorted(row[0] for row in connection.execute(
+    select([Question.id]).where(_matching(ids, connection))))
+  connection.execute(statement.where(_matching(found, connection)))
+  return found
+
+
+'''
+delete_questions(ids) / update_questions(ids, values)
+    apply a batch delete or update as one set-based statement in a single
+    transaction and return the ids it touched
+'''
+def delete_questions(ids):
+  return _commit_batch(Question.__table__.delete(), ids)
+
+
+def update_questions(ids, values):
+  return _commit_batch(Question.__table__.update().values(**values), ids)
+
+
+def _commit_batch(statement, ids):
+  try:
+    touched = _run_returning(statement, ids)
+    if touched:
+      mark_changed(db.session, Question)
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+  return touched
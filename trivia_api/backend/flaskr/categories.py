@@ -0,0 +1,127 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import threading
+from models import Category, Question, current_versions, on_commit, use_primary
+from flaskr.projections import CATEGORIES, CATEGORY_DIFFICULTY_COUNTS
+
+'''
+CategorySnapshot
+    process-local copy of the categories table, kept as the id -> type dict
+    the endpoints return. It is reloaded once the categories version in
+    data_versions moves, so writes from any worker refresh it; hits and
+    misses are counted
+'''
+class CategorySnapshot:
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self._snapshot = None
+    self._lock = threading.Lock()
+
+  def get(self):
+    # read the version before querying so a write racing the reload
+    # leaves the snapshot stale instead of hiding the change. Reloads
+    # follow commits, so the rows come from the primary, not a replica
+    version = current_versions().get('categories', 0)
+    categories = self.cached(version)
+    if categories is not None:
+      return categories
+    with use_primary():
+      return self.store(version, CATEGORIES.execute().fetchall())
+
+  def cached(self, version):
+    '''the snapshot when it was read at version, counting a hit or a miss'''
+    snapshot = self._snapshot
+    if snapshot is not None and snapshot[0] == version:
+      with self._lock:
+        self.hits += 1
+      return snapshot[1]
+
+    with self._lock:
+      self.misses += 1
+    return None
+
+  def store(self, version, rows):
+    '''keeps the (id, type) rows read at version and returns them as the dict'''
+    categories = {'{}'.format(category_id): '{}'.format(category_type)
+                  for category_id, category_type in rows}
+    self._snapshot = (version, categories)
+    return categories
+
+  def invalidate(self):
+    self._snapshot = None
+
+  def stats(self):
+    snapshot = self._snapshot
+    return {
+      'version': snapshot[0] if snapshot is not None else None,
+      'hits': self.hits,
+      'misses': self.misses,
+      'loaded': snapshot is not None
+    }
+
+
+category_snapshot = CategorySnapshot()
+
+# the version check already covers writes; this lets invalidate_caches() reach it
+on_commit(Category, category_snapshot.invalidate)
+
+
+'''
+CategoryStats
+    question count, average difficulty and difficulty histogram of each
+    category that has questions, all computed by one GROUP BY category_id,
+    difficulty over questions. The result is kept until the questions
+    version in data_versions moves, so writes from any worker refresh it
+'''
+class CategoryStats:
+  def __init__(self):
+    self._stats = None
+    self._lock = threading.Lock()
+
+  def get(self):
+    version = current_versions().get('questions', 0)
+    stats = self.cached(version)
+    if stats is not None:
+      return stats
+    return self.store(version, CATEGORY_DIFFICULTY_COUNTS.execute())
+
+  def cached(self, version):
+    stats = self._stats
+    if stats is not None and stats[0] == version:
+      return stats[1]
+    return None
+
+  def store(self, version, rows):
+    '''
+    keeps the stats summarized from the (category_id, difficulty, count)
+    rows read at version and returns them
+    '''
+    result = {}
+    for category_id, difficulty, count in rows:
+      category = result.setdefault(category_id, {'total_questions': 0, 'difficulty_histogram': {}})
+      category['total_questions'] += count
+      if difficulty is not None:
+        category['difficulty_histogram'][difficulty] = count
+
+    for category in result.values():
+      histogram = category['difficulty_histogram']
+      rated = sum(histogram.values())
+      category['average_difficulty'] = round(
+        sum(difficulty * count for difficulty, count in histogram.items()) / rated, 2) if rated else None
+      category['difficulty_histogram'] = {'{}'.format(difficulty): histogram[difficulty]
+                                          for difficulty in sorted(histogram)}
+
+    with self._lock:
+      self._stats = (version, result)
+    return result
+
+  def invalidate(self):
+    with self._lock:
+      self._stats = None
+
+
+category_stats = CategoryStats()
+
+# the version check already covers writes; this lets invalidate_caches() reach it
+on_commit(Question, category_stats.invalidate)
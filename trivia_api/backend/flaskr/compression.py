@@ -0,0 +1,100 @@
+import zlib
+from flask import request
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/html', 'text/plain')
+
+
+def gzip_compressor(level):
+  # wbits 16 + MAX_WBITS writes the gzip header and trailer
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress, compressor.flush
+
+
+def brotli_compressor(level):
+  compressor = brotli.Compressor(quality=min(level, 11))
+  return compressor.process, compressor.finish
+
+
+COMPRESSORS = {'br': brotli_compressor, 'gzip': gzip_compressor}
+
+
+def available_encodings():
+  return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+'''
+compress_chunks(chunks, compressor)
+    compresses a streamed body chunk by chunk, so exports stay streamed
+'''
+def compress_chunks(chunks, compressor):
+  compress, finish = compressor
+  for chunk in chunks:
+    data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    if data:
+      yield data
+  yield finish()
+
+
+'''
+compress_data(data, encoding, level, min_size)
+    a buffered body compressed with encoding, or None when it is under
+    min_size bytes and is better sent as it is
+'''
+def compress_data(data, encoding, level, min_size):
+  if len(data) < min_size:
+    return None
+  compress, finish = COMPRESSORS[encoding](level)
+  return compress(data) + finish()
+
+
+def compression_settings(config):
+  '''the enabled encodings, minimum body size and level set in config'''
+  encodings = [encoding for encoding in config.get('COMPRESSION', available_encodings())
+               if encoding in COMPRESSORS and (encoding != 'br' or brotli is not None)]
+  return encodings, config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE), config.get('COMPRESS_LEVEL', COMPRESS_LEVEL)
+
+
+'''
+init_compression(app)
+    compresses responses for clients that accept it. The encoding is the
+    first of COMPRESSION (default: br when brotli is installed, then gzip)
+    listed in Accept-Encoding. Buffered bodies under COMPRESS_MIN_SIZE bytes
+    are sent as they are, and streamed bodies are always compressed. ETags
+    of compressed responses become weak, as the bytes differ from the
+    identity encoding
+'''
+def init_compression(app):
+  encodings, min_size, level = compression_settings(app.config)
+
+  @app.after_request
+  def compress_response(response):
+    if not encodings or response.status_code != 200 or \
+        response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers:
+      return response
+    response.vary.add('Accept-Encoding')
+
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+      return response
+
+    if response.is_streamed:
+      response.response = compress_chunks(response.response, COMPRESSORS[encoding](level))
+      response.headers.pop('Content-Length', None)
+    else:
+      data = compress_data(response.get_data(), encoding, level, min_size)
+      if data is None:
+        return response
+      response.set_data(data)
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+      response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,70 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import functools
+import hashlib
+from flask import current_app, make_response, request
+from models import current_versions
+from flaskr.response_cache import cache_get, cache_set
+
+'''
+data_etag(*models)
+    the ETag of a response built from the given tables: their current
+    DataVersion counters, read with one primary-key lookup
+'''
+def data_etag(*models):
+  return versions_etag(current_versions(), *models)
+
+
+def versions_etag(versions, *models):
+  '''the ETag of the given tables at versions, a table name -> version dict'''
+  return '-'.join('{}'.format(versions.get(model.__tablename__, 0)) for model in models)
+
+
+'''
+cache_key(etag)
+    the response cache key of the current request: database, path with its
+    query string (category, page or cursor) and the data version, hashed
+'''
+def cache_key(etag):
+  return response_key(current_app.config['SQLALCHEMY_DATABASE_URI'], request.full_path, etag)
+
+
+def response_key(database_uri, full_path, etag):
+  key = '{}|{}|{}'.format(database_uri, full_path, etag)
+  return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+'''
+conditional(*models, cache=False)
+    decorates a read endpoint whose body only depends on the given tables:
+    successful responses carry an ETag built from their versions, and a
+    request whose If-None-Match still holds it is answered 304 before the
+    view runs any of its listing queries. With cache, successful bodies are
+    also kept in the app's response cache, keyed on that version, so a write
+    moves every worker on to fresh entries as soon as it commits
+'''
+def conditional(*models, cache=False):
+  def decorator(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+      etag = data_etag(*models)
+      # compressed responses carry the weak form of the same ETag
+      if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+      store = current_app.extensions.get('response_cache') if cache else None
+      body = cache_get(store, cache_key(etag)) if store is not None else None
+      if body is not None:
+        response = current_app.response_class(body, mimetype='application/json')
+      else:
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+          return response
+        if store is not None:
+          cache_set(store, cache_key(etag), response.get_data())
+      response.set_etag(etag)
+      return response
+    return wrapper
+  return decorator
@@ -0,0 +1,62 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import csv
+import io
+from models import Question, db
+from flaskr.serialization import dumps
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = ('id', 'question', 'answer', 'difficulty', 'category_id')
+EXPORT_MIMETYPES = {
+  'ndjson': 'application/x-ndjson',
+  'csv': 'text/csv'
+}
+
+'''
+export_rows(category_id=None)
+    iterates over the question bank as tuples of EXPORT_COLUMNS, read from
+    a server-side cursor EXPORT_BATCH_SIZE rows at a time so memory stays
+    flat whatever the table size
+'''
+def export_rows(category_id=None):
+  selection = db.session.query(*(getattr(Question, column) for column in EXPORT_COLUMNS))
+  if category_id is not None:
+    selection = selection.filter(Question.category_id == category_id)
+  return selection.order_by(Question.id) \
+    .execution_options(stream_results=True) \
+    .yield_per(EXPORT_BATCH_SIZE)
+
+
+'''
+ndjson_chunks(rows) / csv_chunks(rows)
+    encode rows one batch per chunk, so the response is written in a few
+    large pieces instead of one per question
+'''
+def ndjson_chunks(rows):
+  lines = []
+  for row in rows:
+    lines.append(dumps(dict(zip(EXPORT_COLUMNS, row))))
+    if len(lines) == EXPORT_BATCH_SIZE:
+      yield b'\n'.join(lines) + b'\n'
+      lines = []
+  if lines:
+    yield b'\n'.join(lines) + b'\n'
+
+
+def csv_chunks(rows):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  writer.writerow(EXPORT_COLUMNS)
+  for count, row in enumerate(rows, 1):
+    writer.writerow(row)
+    if count % EXPORT_BATCH_SIZE == 0:
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+  yield buffer.getvalue()
+
+
+EXPORT_FORMATS = {
+  'ndjson': ndjson_chunks,
+  'csv': csv_chunks
+}
@@ -0,0 +1,150 @@
+import bisect
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+'''
+Histogram(name, help, buckets)
+    a Prometheus histogram with one series per label tuple; observations
+    are counted in the first bucket they fit, and render() writes the
+    cumulative counts of the text exposition format
+'''
+class Histogram:
+  def __init__(self, name, help, buckets):
+    self.name = name
+    self.help = help
+    self.buckets = buckets
+    self._series = {}
+
+  def observe(self, labels, value):
+    series = self._series.get(labels)
+    if series is None:
+      series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+    series[0][bisect.bisect_left(self.buckets, value)] += 1
+    series[1] += value
+    series[2] += 1
+
+  def render(self, label_names):
+    lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+    for labels, (counts, total, count) in sorted(self._series.items()):
+      label_text = format_labels(label_names, labels)
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+        cumulative += bucket_count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label_text, bound, cumulative))
+      lines.append('{}_sum{{{}}} {}'.format(self.name, label_text, repr(total)))
+      lines.append('{}_count{{{}}} {}'.format(self.name, label_text, count))
+    return lines
+
+
+def format_labels(names, values):
+  return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                  for name, value in zip(names, values))
+
+
+'''
+RequestMetrics
+    per-process request metrics, labelled by route and method: latency,
+    SQL statements and SQL time per request, and response size, plus a
+    request counter by status code
+'''
+class RequestMetrics:
+  LABELS = ('endpoint', 'method')
+
+  def __init__(self):
+    self.latency = Histogram('trivia_request_duration_seconds',
+                             'Time spent handling a request.', LATENCY_BUCKETS)
+    self.statements = Histogram('trivia_request_sql_statements',
+                                'SQL statements executed by a request.', STATEMENT_BUCKETS)
+    self.sql_time = Histogram('trivia_request_sql_seconds',
+                              'Time spent in SQL statements by a request.', LATENCY_BUCKETS)
+    self.size = Histogram('trivia_response_size_bytes',
+                          'Size of response bodies, streamed bodies excluded.', SIZE_BUCKETS)
+    self.requests = {}
+    self._lock = threading.Lock()
+
+  def record(self, endpoint, method, status, seconds, statements, sql_seconds, size):
+    labels = (endpoint, method)
+    with self._lock:
+      self.latency.observe(labels, seconds)
+      self.statements.observe(labels, statements)
+      self.sql_time.observe(labels, sql_seconds)
+      if size is not None:
+        self.size.observe(labels, size)
+      key = labels + (status,)
+      self.requests[key] = self.requests.get(key, 0) + 1
+
+  def render(self):
+    with self._lock:
+      lines = ['# HELP trivia_requests_total Requests handled.', '# TYPE trivia_requests_total counter']
+      lines.extend('trivia_requests_total{{{}}} {}'.format(
+        format_labels(self.LABELS + ('status',), key), count) for key, count in sorted(self.requests.items()))
+      for histogram in (self.latency, self.statements, self.sql_time, self.size):
+        lines.extend(histogram.render(self.LABELS))
+    return '\n'.join(lines) + '\n'
+
+
+'''
+SQL accounting: engine events add the count and duration of every
+statement executed while a request is handled to flask.g
+'''
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+  elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+  if has_request_context():
+    g.sql_statements = g.get('sql_statements', 0) + 1
+    g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+
+
+'''
+init_metrics(app)
+    records every request in app.extensions['metrics'] for GET /metrics.
+    With SERVER_TIMING on, responses also carry a Server-Timing header with
+    the SQL time and statement count and the total handling time. Call it
+    before init_compression so sizes are measured on the wire
+'''
+def init_metrics(app):
+  metrics = app.extensions['metrics'] = RequestMetrics()
+  server_timing = app.config.get('SERVER_TIMING', False)
+
+  @app.before_request
+  def start_timer():
+    g.request_start = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+  @app.after_request
+  def record_request(response):
+    if 'request_start' not in g:
+      return response
+    seconds = time.perf_counter() - g.request_start
+    statements = g.get('sql_statements', 0)
+    sql_seconds = g.get('sql_seconds', 0.0)
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    size = None if response.is_streamed else response.calculate_content_length()
+    metrics.record(endpoint, request.method, response.status_code, seconds, statements, sql_seconds, size)
+
+    if server_timing:
+      response.headers.extend(timing_headers(seconds, statements, sql_seconds))
+    return response
+
+
+def timing_headers(seconds, statements, sql_seconds):
+  '''the Server-Timing headers of a request, also sent by the async views'''
+  return {
+    'Server-Timing': 'db;dur={:.2f};desc="{} queries", total;dur={:.2f}'.format(
+      sql_seconds * 1000, statements, seconds * 1000),
+    'Timing-Allow-Origin': '*'
+  }
@@ -0,0 +1,103 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import base64
+import binascii
+from flask import abort
+from sqlalchemy import func, text
+from models import db
+
+QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+COUNT_ESTIMATE_THRESHOLD = 100000
+COUNT_ESTIMATE = text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)")
+
+'''
+paginate(request, projection, **params)
+    returns the rows of the requested page as dicts; the page is cut with
+    LIMIT/OFFSET in the database so only QUESTIONS_PER_PAGE rows are loaded.
+    params fill the other bindparams of the projection
+'''
+def paginate(request, projection, **params):
+  bounds = page_params(request.args)
+  if bounds is None:
+    return []
+  return projection.all(**bounds, **params)
+
+
+def page_params(args):
+  '''the offset and limit of the ?page= in args, None for pages below 1'''
+  page = args.get('page', 1, type=int)
+  if page < 1:
+    return None
+  return {'offset': (page - 1) * QUESTIONS_PER_PAGE, 'limit': QUESTIONS_PER_PAGE}
+
+
+'''
+encode_cursor(question_id) / decode_cursor(cursor)
+    turn the id of the last question on a page into the opaque next_cursor
+    handed to clients and back; malformed cursors abort with 400
+'''
+def encode_cursor(question_id):
+  return base64.urlsafe_b64encode(str(question_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+  if not cursor:
+    return None
+  try:
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return int(base64.urlsafe_b64decode(padded.encode()).decode())
+  except (binascii.Error, UnicodeDecodeError, ValueError):
+    abort(400)
+
+
+'''
+paginate_keyset(request, projection, **params)
+    returns the rows following the ?after_id= cursor together with the
+    cursor of the next page (None on the last one). The projection seeks on
+    id (category_id, id for category listings) instead of skipping rows, so
+    deep pages cost the same as the first one and stay stable under deletes
+'''
+def paginate_keyset(request, projection, **params):
+  bounds, limit = keyset_params(request.args)
+  return keyset_page(projection.all(**bounds, **params), limit)
+
+
+def keyset_params(args):
+  '''
+  the after_id and limit to query for the ?after_id= and ?limit= in args,
+  with the page size; one row more than the page is read to tell whether
+  another page follows
+  '''
+  after_id = decode_cursor(args.get('after_id', ''))
+  limit = args.get('limit', QUESTIONS_PER_PAGE, type=int)
+  limit = max(1, min(limit, MAX_QUESTIONS_PER_PAGE))
+  # ids start at 1, so the first page seeks past 0
+  return {'after_id': after_id or 0, 'limit': limit + 1}, limit
+
+
+def keyset_page(questions, limit):
+  '''cuts the rows read for keyset_params to the page and its next_cursor'''
+  next_cursor = None
+  if len(questions) > limit:
+    questions = questions[:limit]
+    next_cursor = encode_cursor(questions[-1]['id'])
+  return questions, next_cursor
+
+
+'''
+count_rows(selection, estimate=True)
+    returns the number of rows matched by a query with a single count(*);
+    with estimate, unfiltered postgres tables above COUNT_ESTIMATE_THRESHOLD
+    rows are answered from the planner estimate in pg_class instead. Write
+    responses pass estimate=False: the estimate lags until the next ANALYZE
+'''
+def count_rows(selection, estimate=True):
+  entity = selection.column_descriptions[0]['entity']
+
+  if estimate and selection.whereclause is None and db.engine.dialect.name == 'postgresql':
+    rows = db.session.execute(COUNT_ESTIMATE, {'table': entity.__tablename__}).scalar()
+    if rows is not None and rows > COUNT_ESTIMATE_THRESHOLD:
+      return rows
+
+  return selection.with_entities(func.count(entity.id)).order_by(None).scalar()
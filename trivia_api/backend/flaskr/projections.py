@@ -0,0 +1,81 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+from flask import current_app
+from sqlalchemy import and_, bindparam, func, select
+from sqlalchemy.util import LRUCache
+from models import Category, Question, db
+
+COMPILED_CACHE_SIZE = 100
+QUESTION_FIELDS = ('id', 'question', 'answer', 'difficulty', 'category_id')
+
+questions = Question.__table__
+categories = Category.__table__
+question_columns = [questions.c[field] for field in QUESTION_FIELDS]
+
+'''
+Projection(statement)
+    a Core select built once at import, with a bindparam for everything
+    that varies between requests. all(**params) returns its rows as plain
+    dicts keyed like Model.format(), without building ORM instances or
+    touching the identity map; with the app's compiled statement cache the
+    SQL of each projection is compiled once per database dialect
+'''
+class Projection:
+  def __init__(self, statement):
+    self.statement = statement
+
+  def execute(self, **params):
+    connection = db.session.connection()
+    cache = current_app.extensions.get('compiled_cache')
+    if cache is not None:
+      connection = connection.execution_options(compiled_cache=cache)
+    return connection.execute(self.statement, params)
+
+  def all(self, **params):
+    result = self.execute(**params)
+    keys = result.keys()
+    return [dict(zip(keys, row)) for row in result]
+
+
+'''
+question_page(*criteria, order_by=None) / questions_after(*criteria)
+    projections of a LIMIT/OFFSET page and of a keyset page (ids above
+    :after_id) of the questions matching criteria
+'''
+def question_page(*criteria, order_by=None):
+  statement = select(question_columns)
+  if criteria:
+    statement = statement.where(and_(*criteria))
+  return Projection(statement.order_by(*(order_by or [questions.c.id]))
+                    .limit(bindparam('limit')).offset(bindparam('offset')))
+
+
+def questions_after(*criteria):
+  return Projection(select(question_columns)
+                    .where(and_(questions.c.id > bindparam('after_id'), *criteria))
+                    .order_by(questions.c.id)
+                    .limit(bindparam('limit')))
+
+
+QUESTION_PAGE = question_page()
+QUESTIONS_AFTER = questions_after()
+CATEGORY_QUESTION_PAGE = question_page(questions.c.category_id == bindparam('category_id'))
+CATEGORY_QUESTIONS_AFTER = questions_after(questions.c.category_id == bindparam('category_id'))
+QUESTIONS_BY_ID = Projection(select(question_columns)
+                             .where(questions.c.id.in_(bindparam('ids', expanding=True))))
+CATEGORIES = Projection(select([categories.c.id, categories.c.type]).order_by(categories.c.id))
+CATEGORY_DIFFICULTY_COUNTS = Projection(
+  select([questions.c.category_id, questions.c.difficulty, func.count(questions.c.id)])
+  .group_by(questions.c.category_id, questions.c.difficulty))
+
+
+'''
+init_projections(app)
+    gives the app an LRU cache of compiled statements unless
+    COMPILED_STATEMENT_CACHE is off
+'''
+def init_projections(app):
+  if app.config.get('COMPILED_STATEMENT_CACHE', True):
+    app.extensions['compiled_cache'] = LRUCache(COMPILED_CACHE_SIZE)
+  else:
+    app.extensions['compiled_cache'] = None
@@ -0,0 +1,137 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+QUIZ_SESSION_TTL = 3600
+QUIZ_SESSION_MAX = 100000
+# bottom of every Redis deck, so a drained deck still exists
+DECK_BOTTOM = 0
+
+'''
+MemoryDeckStore
+    default quiz session store: keeps each session's shuffled deck of
+    question ids as a compact array in process memory. A session expires
+    after ttl seconds without a round; expired sessions are purged from the
+    front of the recency-ordered dict on every call, and past max_sessions
+    the least recently played are dropped.
+
+    Other backends, like RedisDeckStore, only need the same three methods:
+      create(deck) -> session id
+      pop(session_id) -> next question id, None once the deck is empty;
+                         raises KeyError for unknown or expired sessions
+      delete(session_id)
+'''
+class MemoryDeckStore:
+  def __init__(self, ttl=QUIZ_SESSION_TTL, max_sessions=QUIZ_SESSION_MAX):
+    self.ttl = ttl
+    self.max_sessions = max_sessions
+    self._decks = OrderedDict()
+    self._lock = threading.Lock()
+
+  def create(self, deck):
+    session_id = secrets.token_urlsafe(16)
+    with self._lock:
+      self._purge()
+      self._decks[session_id] = (time.monotonic() + self.ttl, array('l', deck))
+      while len(self._decks) > self.max_sessions:
+        self._decks.popitem(last=False)
+    return session_id
+
+  def pop(self, session_id):
+    with self._lock:
+      self._purge()
+      _, deck = self._decks.pop(session_id)
+      self._decks[session_id] = (time.monotonic() + self.ttl, deck)
+      return deck.pop() if len(deck) else None
+
+  def delete(self, session_id):
+    with self._lock:
+      self._decks.pop(session_id, None)
+
+  def __len__(self):
+    return len(self._decks)
+
+  def _purge(self):
+    now = time.monotonic()
+    while self._decks:
+      session_id, (expires_at, _) = next(iter(self._decks.items()))
+      if expires_at > now:
+        break
+      del self._decks[session_id]
+
+
+'''
+RedisDeckStore
+    quiz session store on any Redis-protocol server, so a session can be
+    played through workers on several hosts. client is a redis-py style
+    client (rpush, rpop, pexpire, delete); each deck is a list under
+    prefix + session id, with DECK_BOTTOM below the ids, and expires after
+    ttl seconds without a round
+'''
+class RedisDeckStore:
+  def __init__(self, client, ttl=QUIZ_SESSION_TTL, prefix='trivia:quiz:'):
+    self.client = client
+    self.ttl = ttl
+    self.prefix = prefix
+
+  @classmethod
+  def from_url(cls, url, **kwargs):
+    import redis
+    return cls(redis.Redis.from_url(url), **kwargs)
+
+  def create(self, deck):
+    session_id = secrets.token_urlsafe(16)
+    key = self.prefix + session_id
+    self.client.rpush(key, DECK_BOTTOM, *deck)
+    self.client.pexpire(key, int(self.ttl * 1000))
+    return session_id
+
+  def pop(self, session_id):
+    key = self.prefix + session_id
+    question_id = self.client.rpop(key)
+    if question_id is None:
+      raise KeyError(session_id)
+    question_id = int(question_id)
+    if question_id == DECK_BOTTOM:
+      # put the bottom back so the drained session keeps answering None
+      self.client.rpush(key, DECK_BOTTOM)
+      question_id = None
+    self.client.pexpire(key, int(self.ttl * 1000))
+    return question_id
+
+  def delete(self, session_id):
+    self.client.delete(self.prefix + session_id)
+
+
+'''
+init_quiz_sessions(app)
+    sets up the store named by QUIZ_SESSION_STORE: 'memory' (the default,
+    holding up to QUIZ_SESSION_MAX sessions), 'redis' (at QUIZ_SESSION_URL)
+    or a ready store object. Sessions expire after QUIZ_SESSION_TTL seconds
+    without a round
+'''
+def init_quiz_sessions(app):
+  store = app.config.get('QUIZ_SESSION_STORE') or 'memory'
+  ttl = app.config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL)
+
+  if store == 'memory':
+    store = MemoryDeckStore(ttl, app.config.get('QUIZ_SESSION_MAX', QUIZ_SESSION_MAX))
+  elif store == 'redis':
+    store = RedisDeckStore.from_url(app.config['QUIZ_SESSION_URL'], ttl=ttl)
+  app.extensions['quiz_sessions'] = store
+  return store
+
+
+'''
+shuffled_deck(ids)
+    returns a shuffled copy of a pool's id array, shuffled once per session
+'''
+def shuffled_deck(ids):
+  deck = array('l', ids)
+  random.shuffle(deck)
+  return deck
@@ -0,0 +1,73 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db
+
+READ_METHODS = ('GET', 'HEAD')
+# holds the time until which the client reads from the primary
+PRIMARY_COOKIE = 'trivia_primary_until'
+
+'''
+read_only(view)
+    marks a view that only reads although its method is not GET, like the
+    quiz sampler, so it is routed to the replicas as well
+'''
+def read_only(view):
+  view.read_only = True
+  return view
+
+
+'''
+Writes committed while a request is handled, noted for read-your-writes;
+inserted ahead of the models listener that clears changed_models
+'''
+@event.listens_for(Session, 'after_commit', insert=True)
+def _note_writes(session):
+  if has_request_context() and session.info.get('changed_models'):
+    g.committed_writes = True
+
+
+def reads_primary_until():
+  try:
+    return float(request.cookies.get(PRIMARY_COOKIE, 0))
+  except ValueError:
+    return 0
+
+
+'''
+init_replicas(app)
+    routes GET requests and read_only views to the replicas passed to
+    setup_db, see models.RoutingSession; other requests use the primary.
+    With READ_YOUR_WRITES set to a number of seconds, a response to a
+    request that committed writes carries a cookie that sends the client's
+    reads to the primary for that long, so it sees its own writes despite
+    replication lag
+'''
+def init_replicas(app):
+  read_your_writes = app.config.get('READ_YOUR_WRITES', 0)
+
+  @app.before_request
+  def route_reads():
+    if app.extensions.get('replicas') is None:
+      return
+    view = app.view_functions.get(request.endpoint)
+    if request.method in READ_METHODS or getattr(view, 'read_only', False):
+      g.read_replica = reads_primary_until() <= time.time()
+
+  @app.after_request
+  def stick_to_primary(response):
+    if read_your_writes and g.get('committed_writes') and response.status_code < 400:
+      response.set_cookie(PRIMARY_COOKIE, '{:.3f}'.format(time.time() + read_your_writes),
+                          max_age=read_your_writes, httponly=True)
+    return response
+
+  @app.teardown_appcontext
+  def release_replica(error):
+    connection = g.pop('replica_connection', None)
+    if connection is not None:
+      # end the session's transaction on the connection before returning it
+      db.session.remove()
+      connection.close()
@@ -0,0 +1,159 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+RESPONSE_CACHE_TTL = 60
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+RESPONSE_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'trivia_response_cache.sqlite3')
+EVICT_EVERY = 100
+# a hit records its time only when the last one is older, so most hits
+# read without taking the SQLite write lock
+RESPONSE_CACHE_TOUCH_AFTER = 10
+
+logger = logging.getLogger(__name__)
+
+'''
+SQLiteCache
+    default response cache, shared by every worker on the host through one
+    SQLite file in WAL mode. Entries expire after ttl seconds, and once the
+    file holds more than max_entries the least recently used are evicted;
+    recency is kept to touch_after seconds. Each thread of each process
+    opens its own connection
+'''
+class SQLiteCache:
+  def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL,
+               max_entries=RESPONSE_CACHE_MAX_ENTRIES, touch_after=RESPONSE_CACHE_TOUCH_AFTER):
+    self.path = path
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.touch_after = touch_after
+    self.hits = 0
+    self.misses = 0
+    self._writes = 0
+    self._local = threading.local()
+
+  def _connection(self):
+    # connections must not cross a fork, so they are keyed by pid
+    if getattr(self._local, 'pid', None) != os.getpid():
+      connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                         'expires REAL NOT NULL, used REAL NOT NULL)')
+      connection.execute('CREATE INDEX IF NOT EXISTS ix_responses_used ON responses (used)')
+      self._local.connection = connection
+      self._local.pid = os.getpid()
+    return self._local.connection
+
+  def get(self, key):
+    now = time.time()
+    connection = self._connection()
+    row = connection.execute(
+      'SELECT value, used FROM responses WHERE key = ? AND expires > ?', (key, now)).fetchone()
+    if row is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    if now - row[1] >= self.touch_after:
+      connection.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+    return bytes(row[0])
+
+  def set(self, key, value):
+    now = time.time()
+    self._connection().execute(
+      'INSERT OR REPLACE INTO responses (key, value, expires, used) VALUES (?, ?, ?, ?)',
+      (key, value, now + self.ttl, now))
+    self._writes += 1
+    if self._writes % EVICT_EVERY == 0:
+      self.evict()
+
+  def evict(self):
+    connection = self._connection()
+    connection.execute('DELETE FROM responses WHERE expires <= ?', (time.time(),))
+    connection.execute('DELETE FROM responses WHERE key IN ('
+                       'SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                       (self.max_entries,))
+
+  def clear(self):
+    self._connection().execute('DELETE FROM responses')
+
+
+'''
+RedisCache
+    response cache on any Redis-protocol server, for workers spread over
+    several hosts. client is a redis-py style client (get, set with px,
+    delete, scan_iter); entries expire through PX, and LRU eviction is left
+    to the server's maxmemory-policy (allkeys-lru)
+'''
+class RedisCache:
+  def __init__(self, client, ttl=RESPONSE_CACHE_TTL, prefix='trivia:response:'):
+    self.client = client
+    self.ttl = ttl
+    self.prefix = prefix
+    self.hits = 0
+    self.misses = 0
+
+  @classmethod
+  def from_url(cls, url, **kwargs):
+    import redis
+    return cls(redis.Redis.from_url(url), **kwargs)
+
+  def get(self, key):
+    value = self.client.get(self.prefix + key)
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return value
+
+  def set(self, key, value):
+    self.client.set(self.prefix + key, value, px=int(self.ttl * 1000))
+
+  def clear(self):
+    keys = list(self.client.scan_iter(match=self.prefix + '*'))
+    if keys:
+      self.client.delete(*keys)
+
+
+'''
+cache_get(cache, key) / cache_set(cache, key, value)
+    the calls the views make to the response cache. The cache only saves
+    work, so a failing one (a locked SQLite file, an unreachable Redis
+    server) is logged and the request goes on as a miss
+'''
+def cache_get(cache, key):
+  try:
+    return cache.get(key)
+  except Exception:
+    logger.warning('Response cache read failed', exc_info=True)
+    return None
+
+
+def cache_set(cache, key, value):
+  try:
+    cache.set(key, value)
+  except Exception:
+    logger.warning('Response cache write failed', exc_info=True)
+
+
+'''
+init_response_cache(app)
+    sets up the cache named by RESPONSE_CACHE: 'sqlite' (the default),
+    'redis' (at RESPONSE_CACHE_URL), None to disable it, or a ready cache
+    object with get(key) and set(key, value)
+'''
+def init_response_cache(app):
+  cache = app.config.get('RESPONSE_CACHE', 'sqlite')
+  ttl = app.config.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL)
+
+  if cache == 'sqlite':
+    cache = SQLiteCache(app.config.get('RESPONSE_CACHE_PATH', RESPONSE_CACHE_PATH), ttl,
+                        app.config.get('RESPONSE_CACHE_MAX_ENTRIES', RESPONSE_CACHE_MAX_ENTRIES),
+                        app.config.get('RESPONSE_CACHE_TOUCH_AFTER', RESPONSE_CACHE_TOUCH_AFTER))
+  elif cache == 'redis':
+    cache = RedisCache.from_url(app.config['RESPONSE_CACHE_URL'], ttl=ttl)
+  app.extensions['response_cache'] = cache
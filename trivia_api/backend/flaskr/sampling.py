@@ -0,0 +1,282 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import random
+import threading
+import time
+from array import array
+from flask import current_app
+from models import Question, db, on_commit, use_primary
+from flaskr.projections import QUESTIONS_BY_ID
+
+SAMPLE_ATTEMPTS = 8
+POOL_MAX_AGE = 30
+QUIZ_RAMP_STEP = 3
+RAMP_FALLOFF = 0.25
+
+'''
+AliasTable(outcomes, weights)
+    Vose's alias method: after O(n) setup, pick() returns an outcome with
+    probability proportional to its weight using one random slot and one
+    coin flip. Outcomes with a zero weight are never picked
+'''
+class AliasTable:
+  def __init__(self, outcomes, weights):
+    total = float(sum(weights))
+    if total <= 0:
+      raise ValueError('at least one weight must be positive')
+    self.outcomes = list(outcomes)
+    size = len(self.outcomes)
+    scaled = [weight * size / total for weight in weights]
+    self.probability = [1.0] * size
+    self.alias = list(range(size))
+
+    small = [slot for slot, weight in enumerate(scaled) if weight < 1]
+    large = [slot for slot, weight in enumerate(scaled) if weight >= 1]
+    while small and large:
+      lesser, greater = small.pop(), large.pop()
+      self.probability[lesser] = scaled[lesser]
+      self.alias[lesser] = greater
+      scaled[greater] -= 1 - scaled[lesser]
+      (small if scaled[greater] < 1 else large).append(greater)
+
+  def pick(self, rng=random):
+    slot = rng.randrange(len(self.outcomes))
+    if rng.random() >= self.probability[slot]:
+      slot = self.alias[slot]
+    return self.outcomes[slot]
+
+
+'''
+QuestionPool
+    process-local arrays of question ids per category (None holds every
+    question) used to draw quiz questions without loading the rows. Draws
+    probe random slots and skip excluded ids with a set lookup, falling back
+    to a scan of the array only once nearly every id has been used. Arrays
+    are dropped on committed question writes and after POOL_MAX_AGE seconds
+    so writes made by other workers are picked up too. Weighted draws use
+    the same arrays split per difficulty, with one alias table per category
+    and set of weights
+'''
+class QuestionPool:
+  def __init__(self, max_age=POOL_MAX_AGE):
+    self.max_age = max_age
+    self._ids = {}
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def ids(self, category_id=None):
+    entry = self._ids.get(category_id)
+    if entry is not None and time.monotonic() - entry[0] < self.max_age:
+      return entry[1]
+
+    selection = db.session.query(Question.id)
+    if category_id is not None:
+      selection = selection.filter(Question.category_id == category_id)
+    # a lagging replica would refill the pool without the writes that emptied it
+    with use_primary():
+      ids = array('l', (row[0] for row in selection))
+    with self._lock:
+      self._ids[category_id] = (time.monotonic(), ids)
+    return ids
+
+  def buckets(self, category_id=None):
+    '''
+    returns the ids of the category as a dict of difficulty -> array
+    '''
+    return self._bucket_entry(category_id)[1]
+
+  def _bucket_entry(self, category_id):
+    entry = self._buckets.get(category_id)
+    if entry is not None and time.monotonic() - entry[0] < self.max_age:
+      return entry
+
+    selection = db.session.query(Question.id, Question.difficulty)
+    if category_id is not None:
+      selection = selection.filter(Question.category_id == category_id)
+    buckets = {}
+    with use_primary():
+      for question_id, difficulty in selection:
+        buckets.setdefault(difficulty, array('l')).append(question_id)
+    # the third slot caches alias tables by weights
+    entry = (time.monotonic(), buckets, {})
+    with self._lock:
+      self._buckets[category_id] = entry
+    return entry
+
+  def alias_table(self, category_id, weights):
+    '''
+    returns the alias table picking a difficulty of the category with
+    probability proportional to its weight, or None when no difficulty
+    with a positive weight has questions
+    '''
+    _, buckets, tables = self._bucket_entry(category_id)
+    key = tuple(sorted(weights.items()))
+    if key not in tables:
+      difficulties = [difficulty for difficulty in buckets if weights.get(difficulty, 0) > 0]
+      tables[key] = AliasTable(difficulties, [weights[difficulty] for difficulty in difficulties]) \
+        if difficulties else None
+    return tables[key]
+
+  def ramp_weights(self, category_id, played, step=QUIZ_RAMP_STEP):
+    '''
+    weights that move one difficulty up every step questions played: the
+    target difficulty weighs 1 and each level away from it RAMP_FALLOFF
+    times less
+    '''
+    difficulties = sorted(difficulty for difficulty in self.buckets(category_id) if difficulty is not None)
+    target = min(played // step, len(difficulties) - 1)
+    return {difficulty: RAMP_FALLOFF ** abs(rank - target) for rank, difficulty in enumerate(difficulties)}
+
+  def sample_weighted(self, category_id=None, count=1, exclude=frozenset(), weights=None):
+    '''
+    like sample, but each id is drawn by picking a difficulty from the
+    alias table of weights and then a random slot of its bucket, so a draw
+    costs O(1) whatever the size of the category
+    '''
+    buckets = self.buckets(category_id)
+    table = self.alias_table(category_id, weights)
+    if table is None:
+      return []
+    picked = []
+    seen = set()
+
+    for _ in range(SAMPLE_ATTEMPTS * count):
+      bucket = buckets[table.pick()]
+      candidate = bucket[random.randrange(len(bucket))]
+      if candidate not in exclude and candidate not in seen:
+        seen.add(candidate)
+        picked.append(candidate)
+        if len(picked) == count:
+          return picked
+
+    remaining = {difficulty: [question_id for question_id in bucket
+                              if question_id not in exclude and question_id not in seen]
+                 for difficulty, bucket in buckets.items() if weights.get(difficulty, 0) > 0}
+    while len(picked) < count:
+      live = [difficulty for difficulty in remaining if remaining[difficulty]]
+      if not live:
+        break
+      bucket = remaining[random.choices(live, [weights[difficulty] for difficulty in live])[0]]
+      picked.append(bucket.pop(random.randrange(len(bucket))))
+    return picked
+
+  def sample(self, category_id=None, count=1, exclude=frozenset()):
+    '''
+    returns up to count distinct random ids of the category that are not
+    in exclude; fewer come back once the category runs out
+    '''
+    ids = self.ids(category_id)
+    picked = []
+    seen = set()
+
+    for _ in range(SAMPLE_ATTEMPTS * count if len(ids) else 0):
+      candidate = ids[random.randrange(len(ids))]
+      if candidate not in exclude and candidate not in seen:
+        seen.add(candidate)
+        picked.append(candidate)
+        if len(picked) == count:
+          return picked
+
+    remaining = [question_id for question_id in ids
+                 if question_id not in exclude and question_id not in seen]
+    picked.extend(random.sample(remaining, min(count - len(picked), len(remaining))))
+    return picked
+
+  def draw(self, category_id=None, count=1, exclude=frozenset(), weights=None):
+    '''
+    returns up to count unseen questions of the category as dicts, loaded
+    with one query; ids deleted by another worker refresh the category's
+    arrays and are replaced from them. With weights (difficulty -> weight)
+    the draw is weighted
+    '''
+    ids = self._pick(category_id, count, exclude, weights)
+    drawn = self._questions(ids)
+    if len(drawn) < len(ids):
+      self.discard(category_id)
+      exclude = set(exclude).union(ids)
+      drawn.extend(self._questions(self._pick(category_id, len(ids) - len(drawn), exclude, weights)))
+    return drawn
+
+  def _pick(self, category_id=None, count=1, exclude=frozenset(), weights=None):
+    if weights:
+      return self.sample_weighted(category_id, count, exclude, weights)
+    return self.sample(category_id, count, exclude)
+
+  @staticmethod
+  def _questions(ids):
+    '''
+    returns the questions with the given ids that still exist, in order.
+    Ids a replica does not have yet are looked up again on the primary the
+    pool was loaded from, so replication lag is not taken for deletes
+    '''
+    if len(ids) == 0:
+      return []
+    questions = {question['id']: question for question in QUESTIONS_BY_ID.all(ids=ids)}
+    missing = [question_id for question_id in ids if question_id not in questions]
+    if missing:
+      with use_primary():
+        questions.update((question['id'], question) for question in QUESTIONS_BY_ID.all(ids=missing))
+    return [questions[question_id] for question_id in ids if question_id in questions]
+
+  def discard(self, category_id):
+    '''drops the arrays of one category, leaving the others loaded'''
+    with self._lock:
+      self._ids.pop(category_id, None)
+      self._buckets.pop(category_id, None)
+
+  def invalidate(self):
+    with self._lock:
+      self._ids = {}
+      self._buckets = {}
+
+
+question_pool = QuestionPool()
+
+on_commit(Question, question_pool.invalidate)
+
+
+'''
+quiz_category_id(quiz_category)
+    accepts the category as an id or as the {'type', 'id'} object sent by the
+    frontend; 0, '' and None select every category
+'''
+def quiz_category_id(quiz_category):
+  if isinstance(quiz_category, dict):
+    quiz_category = quiz_category.get('id')
+  if quiz_category in (None, '', 0, '0'):
+    return None
+  return int(quiz_category)
+
+
+'''
+quiz_exclusions(previous_questions)
+    returns the set of ids already played, given as ids or question objects
+'''
+def quiz_exclusions(previous_questions):
+  return {
+    int(question['id'] if isinstance(question, dict) else question)
+    for question in previous_questions or []
+  }
+
+
+'''
+quiz_difficulty_weights(body, category_id, played, pool=question_pool)
+    the difficulty weights of a quiz request: difficulty_weights as a
+    {difficulty: weight} object, difficulty_ramp for weights that follow the
+    number of questions played in pool, or else the QUIZ_DIFFICULTY_WEIGHTS
+    config. None means an unweighted draw
+'''
+def quiz_difficulty_weights(body, category_id, played, pool=question_pool):
+  weights = body.get('difficulty_weights')
+  if body.get('difficulty_ramp'):
+    return pool.ramp_weights(
+      category_id, played, current_app.config.get('QUIZ_RAMP_STEP', QUIZ_RAMP_STEP))
+  if weights is None:
+    weights = current_app.config.get('QUIZ_DIFFICULTY_WEIGHTS')
+  if weights is None:
+    return None
+
+  weights = {int(difficulty): float(weight) for difficulty, weight in weights.items()}
+  if any(weight < 0 for weight in weights.values()) or not any(weights.values()):
+    raise ValueError('difficulty weights must be non-negative and not all zero')
+  return weights
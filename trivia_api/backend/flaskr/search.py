@@ -0,0 +1,237 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import current_app
+from sqlalchemy import bindparam, func, text
+from models import Question, db, on_commit, use_primary
+from flaskr.pagination import count_rows
+from flaskr.projections import QUESTION_PAGE, QUESTIONS_BY_ID, question_page
+
+SEARCH_CONFIG = 'english'
+INDEX_MAX_AGE = 30
+TRIGRAM_THRESHOLD = 0.6
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+'''
+question_document()
+    the tsvector over question and answer text; it must stay identical to
+    the expression of the ix_questions_search GIN index so postgres uses it
+'''
+def question_document():
+  return func.to_tsvector(
+    SEARCH_CONFIG,
+    func.coalesce(Question.question, '') + ' ' + func.coalesce(Question.answer, ''))
+
+
+'''
+trigram_document() / TRIGRAM_MATCH
+    question and answer text as one string, the expression of the
+    ix_questions_trigram index, and the index-backed word similarity match
+    against it. The match is raw SQL because SQLAlchemy 1.3 does not escape
+    the % of a custom operator for psycopg2
+'''
+def trigram_document():
+  return func.coalesce(Question.question, '') + ' ' + func.coalesce(Question.answer, '')
+
+
+TRIGRAM_MATCH = "(coalesce(questions.question, '') || ' ' || coalesce(questions.answer, '')) %> :search_term"
+
+FULLTEXT_QUERY = func.plainto_tsquery(SEARCH_CONFIG, bindparam('search_term'))
+FULLTEXT_PAGE = question_page(
+  question_document().op('@@')(FULLTEXT_QUERY),
+  order_by=[func.ts_rank(question_document(), FULLTEXT_QUERY).desc(), Question.id])
+TRIGRAM_PAGE = question_page(
+  text(TRIGRAM_MATCH),
+  order_by=[func.word_similarity(bindparam('search_term'), trigram_document()).desc(), Question.id])
+
+
+def tokenize(value):
+  return [token.lower() for token in TOKEN_PATTERN.findall(value or '')]
+
+
+'''
+trigrams(value)
+    the set of three-letter grams of each word, padded like pg_trgm does
+'''
+def trigrams(value):
+  grams = set()
+  for word in tokenize(value):
+    padded = '  {} '.format(word)
+    grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+  return grams
+
+
+def trigram_threshold():
+  return current_app.config.get('TRIGRAM_THRESHOLD', TRIGRAM_THRESHOLD)
+
+
+'''
+FullTextSearch
+    postgres backend: matches plainto_tsquery against the indexed tsvector,
+    ranks with ts_rank and cuts the page with LIMIT/OFFSET in the database.
+    Pages are returned as dicts, see flaskr.projections
+'''
+class FullTextSearch:
+  def search(self, search_term, offset, limit):
+    if not tokenize(search_term):
+      return QUESTION_PAGE.all(offset=offset, limit=limit), count_rows(Question.query)
+
+    questions = FULLTEXT_PAGE.all(search_term=search_term, offset=offset, limit=limit)
+    selection = Question.query.filter(
+      question_document().op('@@')(func.plainto_tsquery(SEARCH_CONFIG, search_term)))
+    return questions, count_rows(selection)
+
+
+'''
+TrigramSearch
+    postgres backend for fragments and typos: keeps questions whose text
+    holds an extent with word_similarity to the search term of at least
+    TRIGRAM_THRESHOLD, found through the pg_trgm GIN index, best first
+'''
+class TrigramSearch:
+  def search(self, search_term, offset, limit):
+    if not tokenize(search_term):
+      return QUESTION_PAGE.all(offset=offset, limit=limit), count_rows(Question.query)
+
+    db.session.execute(
+      text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+      {'threshold': str(trigram_threshold())})
+    questions = TRIGRAM_PAGE.all(search_term=search_term, offset=offset, limit=limit)
+    selection = Question.query.filter(text(TRIGRAM_MATCH).bindparams(search_term=search_term))
+    return questions, count_rows(selection)
+
+
+'''
+MemoryIndex
+    base of the in-memory fallbacks used on SQLite and in tests. The index
+    is built from the questions table on first use and dropped on committed
+    question writes and after INDEX_MAX_AGE seconds; subclasses provide
+    build(rows) and match(search_term), which returns ranked ids
+'''
+class MemoryIndex:
+  def __init__(self, max_age=INDEX_MAX_AGE):
+    self.max_age = max_age
+    self._index = None
+    self._lock = threading.Lock()
+
+  def _load(self):
+    index = self._index
+    if index is not None and time.monotonic() - index[0] < self.max_age:
+      return index[1]
+
+    rows = db.session.query(Question.id, Question.question, Question.answer).order_by(Question.id)
+    # rebuilt after commits, so never from a replica that has not caught up
+    with use_primary():
+      index = (time.monotonic(), self.build(rows))
+    with self._lock:
+      self._index = index
+    return index[1]
+
+  def search(self, search_term, offset, limit):
+    ids = self.match(search_term)
+    page_ids = ids[offset:offset + limit]
+    if not page_ids:
+      return [], len(ids)
+
+    questions = {question['id']: question for question in QUESTIONS_BY_ID.all(ids=page_ids)}
+    return [questions[question_id] for question_id in page_ids if question_id in questions], len(ids)
+
+  def invalidate(self):
+    with self._lock:
+      self._index = None
+
+
+'''
+InvertedIndex
+    maps each lowercased word of the question and answer text to the ids
+    containing it, and ranks the ids holding every search word by tf-idf.
+    Words are not stemmed
+'''
+class InvertedIndex(MemoryIndex):
+  def build(self, rows):
+    postings = defaultdict(dict)
+    ids = []
+    for question_id, question, answer in rows:
+      ids.append(question_id)
+      for token in tokenize(question) + tokenize(answer):
+        postings[token][question_id] = postings[token].get(question_id, 0) + 1
+    return dict(postings), ids
+
+  def match(self, search_term):
+    postings, ids = self._load()
+    tokens = set(tokenize(search_term))
+    if not tokens:
+      return list(ids)
+
+    matches = [postings.get(token, {}) for token in tokens]
+    candidates = set.intersection(*(set(match) for match in matches))
+    scores = {
+      question_id: sum(
+        match[question_id] * math.log(1 + len(ids) / len(match)) for match in matches)
+      for question_id in candidates
+    }
+    return sorted(candidates, key=lambda question_id: (-scores[question_id], question_id))
+
+
+'''
+TrigramIndex
+    pure-Python counterpart of TrigramSearch: maps trigrams to ids and scores
+    each id by the share of the search term's trigrams it contains
+'''
+class TrigramIndex(MemoryIndex):
+  def build(self, rows):
+    postings = defaultdict(set)
+    ids = []
+    for question_id, question, answer in rows:
+      ids.append(question_id)
+      for gram in trigrams('{} {}'.format(question or '', answer or '')):
+        postings[gram].add(question_id)
+    return dict(postings), ids
+
+  def match(self, search_term):
+    postings, ids = self._load()
+    grams = trigrams(search_term)
+    if not grams:
+      return list(ids)
+
+    shared = Counter()
+    for gram in grams:
+      shared.update(postings.get(gram, ()))
+    threshold = trigram_threshold() * len(grams)
+    candidates = [question_id for question_id, count in shared.items() if count >= threshold]
+    return sorted(candidates, key=lambda question_id: (-shared[question_id], question_id))
+
+
+full_text_search = FullTextSearch()
+trigram_search = TrigramSearch()
+question_index = InvertedIndex()
+trigram_index = TrigramIndex()
+
+on_commit(Question, question_index.invalidate)
+on_commit(Question, trigram_index.invalidate)
+
+SEARCH_BACKENDS = {
+  'fulltext': {'postgresql': full_text_search, 'memory': question_index},
+  'trigram': {'postgresql': trigram_search, 'memory': trigram_index}
+}
+
+
+'''
+search_backend(app, mode)
+    returns the backend for the search mode ('fulltext' or 'trigram'):
+    the postgres implementation on postgres, the in-memory index elsewhere,
+    unless SEARCH_BACKEND names one explicitly
+'''
+def search_backend(app, mode='fulltext'):
+  return SEARCH_BACKENDS[mode][search_backend_name(app)]
+
+
+def search_backend_name(app):
+  name = app.config.get('SEARCH_BACKEND')
+  if name is None:
+    name = 'postgresql' if db.get_engine(app).dialect.name == 'postgresql' else 'memory'
+  return name
@@ -0,0 +1,52 @@
+import json
+from flask import current_app
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+JSON_MIMETYPE = 'application/json'
+
+
+def stdlib_dumps(data):
+  return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(data):
+  return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+SERIALIZERS = {
+  'stdlib': stdlib_dumps,
+  'orjson': orjson_dumps
+}
+
+'''
+init_serialization(app)
+    picks the JSON encoder for the app from JSON_SERIALIZER: 'orjson',
+    'stdlib' or 'auto' (the default), which uses orjson when it is installed
+'''
+def init_serialization(app):
+  name = app.config.get('JSON_SERIALIZER', 'auto')
+  if name == 'auto':
+    name = 'orjson' if orjson is not None else 'stdlib'
+  if name == 'orjson' and orjson is None:
+    raise RuntimeError('JSON_SERIALIZER is orjson but orjson is not installed')
+  app.extensions['json_dumps'] = SERIALIZERS[name]
+
+
+def dumps(data):
+  '''encodes data to JSON bytes with the serializer of the current app'''
+  return current_app.extensions.get('json_dumps', stdlib_dumps)(data)
+
+
+'''
+jsonify(*args, **kwargs)
+    drop-in for flask.jsonify that encodes with the configured serializer
+'''
+def jsonify(*args, **kwargs):
+  if args and kwargs:
+    raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+  data = args[0] if len(args) == 1 else (list(args) if args else kwargs)
+  return current_app.response_class(dumps(data), mimetype=JSON_MIMETYPE)
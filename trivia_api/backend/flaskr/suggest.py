@@ -0,0 +1,168 @@
+# pylint: disable=no-member
+# pylint: disable=import-error
+import re
+import threading
+from bisect import bisect_left, insort
+from sqlalchemy import exc
+from models import Question, db, on_commit, use_primary
+
+SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
+SUGGEST_KEY_LENGTH = 40
+SUGGEST_MAX_AGE = 300
+WORD_START = re.compile(r'\b\w', re.UNICODE)
+
+
+def normalize(value):
+  return ' '.join((value or '').lower().split())
+
+
+'''
+SuggestIndex
+    type-ahead index over question text: a sorted array of (key, id) pairs
+    with one key per word of every question, holding the lowercased text
+    from that word on (cut to SUGGEST_KEY_LENGTH characters). A prefix is
+    answered with one bisect and a scan of the matching run, so lookups
+    never touch the database. Committed inserts, updates and deletes patch
+    it in place; the refresher thread started by init_suggest builds it,
+    rebuilds it after writes that bypass the ORM and every max_age seconds
+    to pick up other workers' writes, and swaps each new build in whole
+'''
+class SuggestIndex:
+  def __init__(self, max_age=SUGGEST_MAX_AGE):
+    self.max_age = max_age
+    self._keys = []
+    self._questions = {}
+    # changes committed while a build reads the table, replayed onto it
+    self._pending = None
+    self._stale = threading.Event()
+    self._refresher = None
+    self._lock = threading.Lock()
+
+  def build(self):
+    self._stale.clear()
+    with self._lock:
+      self._pending = []
+    try:
+      with use_primary():
+        rows = db.session.query(Question.id, Question.question).all()
+    except Exception:
+      with self._lock:
+        self._pending = None
+      raise
+
+    keys = []
+    questions = {}
+    for question_id, question in rows:
+      questions[question_id] = question
+      keys.extend(self._keys_for(question_id, question))
+    keys.sort()
+    with self._lock:
+      self._keys = keys
+      self._questions = questions
+      pending, self._pending = self._pending, None
+      for changes in pending:
+        self._patch(changes)
+
+  def suggest(self, prefix, limit=SUGGESTIONS):
+    '''
+    returns up to limit (id, question) pairs holding a word run starting
+    with prefix, in key order; nothing until the first build
+    '''
+    prefix = normalize(prefix)
+    if not prefix:
+      return []
+    key = prefix[:SUGGEST_KEY_LENGTH]
+
+    suggestions = []
+    seen = set()
+    with self._lock:
+      keys, questions = self._keys, self._questions
+    position = bisect_left(keys, (key,))
+    while position < len(keys) and keys[position][0].startswith(key) and len(suggestions) < limit:
+      question_id = keys[position][1]
+      question = questions.get(question_id)
+      position += 1
+      if question_id in seen or question is None:
+        continue
+      # keys are cut short, so long prefixes are confirmed on the full text
+      if len(prefix) > SUGGEST_KEY_LENGTH and prefix not in normalize(question):
+        continue
+      seen.add(question_id)
+      suggestions.append((question_id, question))
+    return suggestions
+
+  def apply(self, changes):
+    with self._lock:
+      if self._pending is not None:
+        self._pending.append(changes)
+      self._patch(changes)
+
+  def start_refresher(self, app):
+    '''builds the index in a daemon thread and keeps it fresh, once per process'''
+    with self._lock:
+      if self._refresher is not None:
+        return
+      self._refresher = threading.Thread(target=self._refresh, args=(app,),
+                                         name='suggest-refresher', daemon=True)
+    self._refresher.start()
+
+  def _refresh(self, app):
+    while True:
+      try:
+        with app.app_context():
+          self.build()
+      except exc.SQLAlchemyError:
+        app.logger.exception('Could not build the suggest index')
+      self._stale.wait(self.max_age)
+
+  def _patch(self, changes):
+    # called with the lock held
+    if changes is None:
+      self._stale.set()
+      return
+    for operation, values in changes:
+      if operation == 'update' and values['question'] is None:
+        # the text was not loaded at flush, so its old keys are unknown
+        self._stale.set()
+        return
+      self._remove(values['id'])
+      if operation != 'delete':
+        self._add(values['id'], values['question'])
+
+  def _add(self, question_id, question):
+    self._questions[question_id] = question
+    for key in self._keys_for(question_id, question):
+      insort(self._keys, key)
+
+  def _remove(self, question_id):
+    question = self._questions.pop(question_id, None)
+    for key in self._keys_for(question_id, question):
+      position = bisect_left(self._keys, key)
+      if position < len(self._keys) and self._keys[position] == key:
+        del self._keys[position]
+
+  def _keys_for(self, question_id, question):
+    text = normalize(question)
+    return [(text[match.start():match.start() + SUGGEST_KEY_LENGTH], question_id)
+            for match in WORD_START.finditer(text)]
+
+
+suggest_index = SuggestIndex()
+
+on_commit(Question, suggest_index.apply, changes=True)
+
+
+'''
+init_suggest(app)
+    starts the refresher of suggest_index with the app's first request, so
+    it runs in the worker process; requests only ever read the index. With
+    SUGGEST_REFRESH off nothing builds it unless build() is called
+'''
+def init_suggest(app):
+  if not app.config.get('SUGGEST_REFRESH', True):
+    return
+
+  @app.before_first_request
+  def start_suggest_refresher():
+    suggest_index.start_refresher(app)
@@ -0,0 +1,4 @@
+-- Full-text search over question and answer text (POST /search_questions).
+-- The expression must match flaskr.search.question_document().
+CREATE INDEX IF NOT EXISTS ix_questions_search ON questions USING gin
+  (to_tsvector('english', coalesce(question, '') || ' ' || coalesce(answer, '')));
@@ -0,0 +1,5 @@
+-- Substring and typo-tolerant search (POST /search_questions with "mode": "trigram").
+-- The expression must match flaskr.search.trigram_document().
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS ix_questions_trigram ON questions USING gin
+  ((coalesce(question, '') || ' ' || coalesce(answer, '')) gin_trgm_ops);
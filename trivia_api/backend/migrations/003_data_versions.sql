@@ -0,0 +1,7 @@
+-- Per-table version counters behind the ETags of the read endpoints.
+CREATE TABLE IF NOT EXISTS data_versions (
+    name character varying PRIMARY KEY,
+    version integer NOT NULL
+);
+INSERT INTO data_versions (name, version) VALUES ('questions', 0), ('categories', 0)
+    ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,3 @@
+-- Category listings (GET /categories/<id>/questions) and the per-category
+-- quiz pools: filter on category_id, ordered and paged by id.
+CREATE INDEX IF NOT EXISTS ix_questions_category_id_id ON questions (category_id, id);
@@ -1,32 +1,372 @@
 # pylint: disable=no-member  
 # pylint: disable=import-error
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, has_request_context
+from sqlalchemy import Column, String, Integer, DDL, create_engine, event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.pool import QueuePool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_name = "trivia"
-database_path = "postgresql:///{}".format(database_name)
+database_path = os.environ.get('DATABASE_URL', "postgresql:///{}".format(database_name))
+# comma separated, see setup_db()
+replica_paths = [path for path in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if path]
 
-db = SQLAlchemy()
+# seconds an unreachable replica is left out before it is tried again
+REPLICA_RETRY_AFTER = 30
 
 '''
-setup_db(app)
-    binds a flask application and a SQLAlchemy service
+RoutingSession
+    session whose statements go to a replica connection while the app
+    context is routed to the replicas (g.read_replica, set per request by
+    flaskr.replicas), outside use_primary() blocks. Everything else, and
+    every read once no replica can be reached, goes to the primary
 '''
-def setup_db(app, database_path=database_path):
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and g.get('read_replica') and not g.get('use_primary'):
+            if 'replica_connection' not in g:
+                replicas = current_app.extensions.get('replicas')
+                g.replica_connection = replicas.connect() if replicas is not None else None
+            if g.replica_connection is not None:
+                return g.replica_connection
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# app config key -> create_engine() pool argument
+POOL_OPTIONS = {
+    'DB_POOL_SIZE': 'pool_size',
+    'DB_MAX_OVERFLOW': 'max_overflow',
+    'DB_POOL_TIMEOUT': 'pool_timeout',
+    'DB_POOL_RECYCLE': 'pool_recycle',
+    'DB_POOL_PRE_PING': 'pool_pre_ping',
+}
+
+'''
+setup_db(app, database_path, replica_paths=())
+    binds a flask application and a SQLAlchemy service. The DB_POOL_* keys
+    of POOL_OPTIONS set in the app config tune the connection pool; server
+    databases get a MeteredQueuePool so pool_stats() can report waits.
+    replica_paths are read replicas of the primary at database_path; they
+    get engines of their own in app.extensions['replicas'], a ReplicaSet
+    used by the requests flaskr.replicas routes to them. The schema is not
+    touched: restore trivia.psql and apply migrations/, or run
+    create_schema() through `flask init-db`
+'''
+def setup_db(app, database_path=database_path, replica_paths=()):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_REPLICA_URIS"] = list(replica_paths or ())
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app, database_path)
     db.app = app
     db.init_app(app)
+    app.before_request(_forget_versions)
+
+    replicas = [create_engine(path, **dict(engine_options(app, path), pool_pre_ping=True))
+                for path in app.config["SQLALCHEMY_REPLICA_URIS"]]
+    app.extensions['replicas'] = ReplicaSet(
+        replicas, app.config.get('REPLICA_RETRY_AFTER', REPLICA_RETRY_AFTER)) if replicas else None
+
+
+def engine_options(app, path):
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    options.update({argument: app.config[key] for key, argument in POOL_OPTIONS.items() if key in app.config})
+    if not make_url(path).drivername.startswith('sqlite'):
+        options.setdefault('poolclass', MeteredQueuePool)
+    return options
+
+
+'''
+use_primary()
+    reads in the block go to the primary even in a request routed to the
+    replicas, for caches that must not be refilled from a lagging replica
+'''
+@contextmanager
+def use_primary():
+    if not has_app_context():
+        yield
+        return
+    previous = g.get('use_primary', False)
+    g.use_primary = True
+    try:
+        yield
+    finally:
+        g.use_primary = previous
+
+
+'''
+create_schema()
+    creates the tables and indexes missing from the database of the current
+    app, with the data_versions rows of new tables
+'''
+def create_schema():
     db.create_all()
 
+
+'''
+MeteredQueuePool
+    QueuePool that times every checkout, which covers waiting for a free
+    connection and opening a new one, and counts checkouts that timed out
+'''
+class MeteredQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.checkouts, pool.wait_seconds = self.checkouts, self.wait_seconds
+        pool.max_wait_seconds, pool.timeouts = self.max_wait_seconds, self.timeouts
+        return pool
+
+
+'''
+pool_stats(engine=None)
+    live numbers of the engine's connection pool: configured size and
+    overflow, connections checked in and out, current overflow, and for a
+    MeteredQueuePool the checkouts and the time spent in them
+'''
+def pool_stats(engine=None):
+    pool = (engine or db.engine).pool
+    stats = {'pool_class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'timeout': pool.timeout(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    if isinstance(pool, MeteredQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'wait_seconds_total': round(pool.wait_seconds, 6),
+                'wait_seconds_max': round(pool.max_wait_seconds, 6),
+                'timeouts': pool.timeouts,
+            })
+    return stats
+
+'''
+ReplicaSet(engines, retry_after=REPLICA_RETRY_AFTER)
+    read replicas handed out round robin. connect() returns a connection to
+    the next replica that is not ejected, or None when none can be reached.
+    A replica is ejected for retry_after seconds when a connection to it
+    cannot be opened, or when a statement on it fails with a disconnect
+    error; the first connect() after that tries it again
+'''
+class ReplicaSet:
+    def __init__(self, engines, retry_after=REPLICA_RETRY_AFTER):
+        self.engines = list(engines)
+        self.retry_after = retry_after
+        self.ejections = {engine: 0 for engine in self.engines}
+        self._ejected_until = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._handle_error)
+
+    def connect(self):
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.engines)
+        for engine in self.engines[start:] + self.engines[:start]:
+            if not self.healthy(engine):
+                continue
+            try:
+                connection = engine.connect()
+            except exc.DBAPIError:
+                self.eject(engine)
+                continue
+            except exc.TimeoutError:
+                # busy, not down: try the next one without ejecting
+                continue
+            with self._lock:
+                self._ejected_until.pop(engine, None)
+            return connection
+        return None
+
+    def healthy(self, engine):
+        return self._ejected_until.get(engine, 0) <= time.monotonic()
+
+    def eject(self, engine):
+        with self._lock:
+            self._ejected_until[engine] = time.monotonic() + self.retry_after
+            self.ejections[engine] += 1
+
+    def _handle_error(self, context):
+        if context.is_disconnect:
+            self.eject(context.engine)
+
+    def stats(self):
+        return [dict(pool_stats(engine), url=repr(engine.url), healthy=self.healthy(engine),
+                     ejections=self.ejections[engine])
+                for engine in self.engines]
+
+'''
+on_commit(model, callback, changes=False)
+    calls callback() once a session commits an insert, update or delete of
+    a model instance; changes that are rolled back are dropped. With
+    changes=True the callback gets the committed (operation, values) pairs,
+    values holding the column values seen at flush, or None when a write
+    bypassed the ORM and reported itself with mark_changed(session, model)
+'''
+_commit_callbacks = {}
+_versioned_models = set()
+
+def on_commit(model, callback, changes=False):
+    _track(model)
+    _commit_callbacks[model].append((callback, changes))
+
+
+'''
+invalidate_caches()
+    runs every on_commit callback as if all tracked tables had changed
+    outside the ORM, for data replaced behind the app's back: a restored
+    dump or a rolled-back test transaction
+'''
+def invalidate_caches():
+    for callbacks in _commit_callbacks.values():
+        for callback, wants_changes in callbacks:
+            if wants_changes:
+                callback(None)
+            else:
+                callback()
+
+
+def mark_changed(session, model, change=None, connection=None):
+    changed = session.info.setdefault('changed_models', {})
+    if change is None:
+        changed[model] = None
+    elif changed.get(model, []) is not None:
+        changed.setdefault(model, []).append(change)
+    _bump_version(session, model, connection)
+
+
+def _track(model):
+    if model not in _commit_callbacks:
+        _commit_callbacks[model] = []
+        for operation in ('insert', 'update', 'delete'):
+            event.listen(model, 'after_' + operation, _change_recorder(operation))
+
+
+def _change_recorder(operation):
+    def record(mapper, connection, target):
+        values = {attr.key: target.__dict__.get(attr.key) for attr in mapper.column_attrs}
+        mark_changed(object_session(target), mapper.class_, (operation, values), connection)
+    return record
+
+
+'''
+version_tables(*models)
+    keeps a DataVersion counter for each model's table, bumped once inside
+    every transaction that writes to it, so the new version becomes visible
+    together with the data. Read endpoints derive ETags and cache keys from
+    current_versions(), which stays correct across worker processes
+'''
+def version_tables(*models):
+    for model in models:
+        _track(model)
+        _versioned_models.add(model)
+
+
+'''
+current_versions()
+    the DataVersion counters as a table name -> version dict. A request reads
+    them once: its ETag check and the process caches it consults share the
+    lookup until the request commits
+'''
+def current_versions():
+    if not has_request_context():
+        return dict(db.session.query(DataVersion.name, DataVersion.version))
+    if 'data_versions' not in g:
+        g.data_versions = dict(db.session.query(DataVersion.name, DataVersion.version))
+    return g.data_versions
+
+
+def _forget_versions():
+    g.pop('data_versions', None)
+
+
+def _bump_version(session, model, connection=None):
+    bumped = session.info.setdefault('bumped_models', set())
+    if model not in _versioned_models or model in bumped:
+        return
+    bumped.add(model)
+    (connection or session.connection()).execute(
+        DataVersion.__table__.update()
+        .where(DataVersion.name == model.__tablename__)
+        .values(version=DataVersion.version + 1))
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_remaining_versions(session):
+    # a bump made inside a savepoint that was rolled back is redone here
+    for model in session.info.get('changed_models', {}):
+        _bump_version(session, model)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_commit_callbacks(session):
+    session.info.pop('bumped_models', None)
+    if has_app_context() and session.info.get('changed_models'):
+        g.pop('data_versions', None)
+    for model, changes in session.info.pop('changed_models', {}).items():
+        for callback, wants_changes in _commit_callbacks.get(model, ()):
+            if wants_changes:
+                callback(changes)
+            else:
+                callback()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_changed_models(session, previous_transaction):
+    session.info.pop('bumped_models', None)
+    if previous_transaction.parent is None:
+        session.info.pop('changed_models', None)
+
 '''
 Question
 
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  __table_args__ = (
+    # serves the (category_id, id) seek of cursor pagination
+    db.Index('ix_questions_category_id_id', 'category_id', 'id'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
@@ -60,6 +400,13 @@ class Question(db.Model):
       'category_id': self.category_id,
     }
 
+# full-text index over question and answer text, matching
+# flaskr.search.question_document(); other databases search in memory
+event.listen(Question.__table__, 'after_create', DDL(
+  "CREATE INDEX ix_questions_search ON questions USING gin "
+  "(to_tsvector('english', coalesce(question, '') || ' ' || coalesce(answer, '')))"
+).execute_if(dialect='postgresql'))
+
 '''
 Category
 
@@ -81,3 +428,20 @@ class Category(db.Model):
     }
 
 
+
+
+'''
+DataVersion
+    one version counter per table, see version_tables()
+'''
+class DataVersion(db.Model):
+  __tablename__ = 'data_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+
+
+event.listen(DataVersion.__table__, 'after_create', DDL(
+  "INSERT INTO data_versions (name, version) VALUES ('questions', 0), ('categories', 0)"))
+
+version_tables(Question, Category)
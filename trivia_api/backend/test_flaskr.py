@@ -1,41 +1,114 @@
 # pylint: disable=no-member  
 # pylint: disable=import-error
 import os
+import gzip
+import shutil
+import tempfile
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import random
+from collections import Counter
+from unittest import mock
+from sqlalchemy import create_engine, event
 from flaskr import create_app
-from models import setup_db, Question, Category, db
+from models import invalidate_caches, Question, Category, db
 from flaskr.__init__ import paginate
+from flaskr.categories import category_snapshot
+from flaskr.quiz_sessions import MemoryDeckStore, RedisDeckStore
+from flaskr.sampling import AliasTable, question_pool
+from flaskr.response_cache import RedisCache, SQLiteCache
+from flaskr.suggest import suggest_index
 from flask import request
 
+try:
+    from starlette.testclient import TestClient
+    from flaskr.asgi import create_asgi_app
+except ImportError:
+    create_asgi_app = None
+
+DATABASE_NAME = os.environ.get('TRIVIA_TEST_DATABASE', 'trivia_test')
+# set by pytest-xdist (pytest -n 4): each worker clones the test database
+WORKER = os.environ.get('PYTEST_XDIST_WORKER')
+
+
+def maintenance(*statements):
+    engine = create_engine('postgresql:///postgres', isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        for statement in statements:
+            connection.execute(statement)
+    engine.dispose()
+
+
+def start_savepoint(session, transaction, connection):
+    """Run the app's transactions inside a savepoint of the test transaction."""
+    if transaction._parent is None:
+        session.begin_nested()
+
+
+def restart_savepoint(session, transaction):
+    """Open a new savepoint once the app commits or rolls back its own."""
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Build the app once, against this worker's database."""
+        cls.database_name = DATABASE_NAME
+        if WORKER:
+            cls.database_name = '{}_{}'.format(DATABASE_NAME, WORKER)
+            maintenance('DROP DATABASE IF EXISTS {}'.format(cls.database_name),
+                        'CREATE DATABASE {} TEMPLATE {}'.format(cls.database_name, DATABASE_NAME))
+        cls.database_path = "postgresql:///{}".format(cls.database_name)
+        cls.cache_dir = tempfile.mkdtemp()
+        cls.config = {
+            'SQLALCHEMY_DATABASE_URI': cls.database_path,
+            'RESPONSE_CACHE_PATH': os.path.join(cls.cache_dir, 'responses.sqlite3'),
+            # tests build the suggest index themselves, inside their transaction
+            'SUGGEST_REFRESH': False
+        }
+        cls.app = create_app(cls.config)
+        cls.app_session = db.session
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.get_engine(cls.app).dispose()
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
+        if WORKER:
+            maintenance('DROP DATABASE IF EXISTS {}'.format(cls.database_name))
+        if getattr(cls, 'replica_path', None) is not None:
+            maintenance('DROP DATABASE IF EXISTS {}_replica'.format(cls.database_name))
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables and open the transaction the test runs in."""
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql:///{}".format(self.database_name)
-        setup_db(self.app, self.database_path)
-        
         self.new_question = {
             'question': 'How old is the Earth',
             'answer': '4.543 billion years',
             'difficulty': 4,
             'category': 1
         }
-        # binds the app to the current context
+        # every session of every app joins this transaction, rolled back in tearDown
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+            self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        db.session = db.create_scoped_session({'bind': self.connection, 'binds': {}})
+        event.listen(db.session.session_factory, 'after_begin', start_savepoint)
+        event.listen(db.session.session_factory, 'after_transaction_end', restart_savepoint)
+
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        """Roll back everything the test wrote and drop what caches saw."""
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+        invalidate_caches()
+        self.app.extensions['response_cache'].clear()
 
     """
     TODO
@@ -54,6 +127,46 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['current_category'], None)
 
     
+    def test_listing_rows_match_model_format(self):
+        res = self.client().get('/questions?page=1')
+        data = json.loads(res.data)
+
+        with self.app.app_context():
+            expected = [question.format() for question in
+                        Question.query.order_by(Question.id).limit(len(data['questions'])).all()]
+        self.assertEqual(data['questions'], expected)
+        self.assertTrue(len(self.app.extensions['compiled_cache']) > 0)
+
+
+    def test_listing_without_compiled_statement_cache(self):
+        app = self.build_app(COMPILED_STATEMENT_CACHE=False, RESPONSE_CACHE=None)
+        res = app.test_client().get('/categories/1/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(app.extensions['compiled_cache'])
+        self.assertTrue(all(question['category_id'] == 1 for question in data['questions']))
+
+
+    def test_paginated_questions_page_size_and_total(self):
+        res = self.client().get('/questions?page=1')
+        data = json.loads(res.data)
+        total = Question.query.count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), min(total, 10))
+        self.assertEqual(data['total_questions'], total)
+
+
+    def test_write_responses_count_questions_exactly(self):
+        # every table is above the threshold, so only exact counts match
+        with mock.patch('flaskr.pagination.COUNT_ESTIMATE_THRESHOLD', -2):
+            res = self.client().post('/questions', json = self.new_question)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+
     def test_404_sent_requesting_beyond_valid_page(self):
         res = self.client().get('/questions?page=10')
         data = json.loads(res.data)
@@ -63,17 +176,298 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], "Sorry, couldn't find a resource matching your request :(")
     
 
+    def test_cursor_pagination_walks_all_questions(self):
+        ids = []
+        res = self.client().get('/questions?after_id=&limit=5')
+        data = json.loads(res.data)
+        while True:
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(len(data['questions']) <= 5)
+            ids.extend(question['id'] for question in data['questions'])
+            if data['next_cursor'] is None:
+                break
+            res = self.client().get('/questions?after_id={}&limit=5'.format(data['next_cursor']))
+            data = json.loads(res.data)
+        expected = [question.id for question in Question.query.order_by(Question.id).all()]
+
+        self.assertEqual(ids, expected)
+
+
+    def test_cursor_pagination_by_category(self):
+        res = self.client().get('/categories/1/questions?after_id=&limit=1')
+        data = json.loads(res.data)
+        first_id = data['questions'][0]['id']
+        res = self.client().get('/categories/1/questions?after_id={}&limit=1'.format(data['next_cursor']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['category_id'], 1)
+        self.assertTrue(data['questions'][0]['id'] > first_id)
+
+
+    def test_400_invalid_cursor(self):
+        res = self.client().get('/questions?after_id=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    
+    #route("/categories")
+    def test_get_categories(self):
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['number_of_categories'], Category.query.count())
+
+
+    def test_get_category_stats(self):
+        res = self.client().get('/categories/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['categories']), Category.query.count())
+        with self.app.app_context():
+            for category in data['categories']:
+                questions = Question.query.filter(Question.category_id == category['id']).all()
+                self.assertEqual(category['total_questions'], len(questions))
+                self.assertEqual(sum(category['difficulty_histogram'].values()), len(questions))
+                if questions:
+                    self.assertAlmostEqual(category['average_difficulty'],
+                                           sum(q.difficulty for q in questions) / len(questions), places=2)
+
+
+    def test_category_stats_follow_question_writes(self):
+        before = json.loads(self.client().get('/categories/stats').data)['categories'][0]
+        self.client().post('/questions', json = self.new_question)
+        after = json.loads(self.client().get('/categories/stats').data)['categories'][0]
+
+        self.assertEqual(after['id'], 1)
+        self.assertEqual(after['total_questions'], before['total_questions'] + 1)
+        self.assertEqual(after['difficulty_histogram'].get('4', 0),
+                         before['difficulty_histogram'].get('4', 0) + 1)
+
+
+    def test_category_snapshot_follows_writes_from_other_workers(self):
+        self.client().get('/categories')
+        with self.app.app_context():
+            # another worker renames a category; this process runs no commit hooks
+            db.session.execute("UPDATE categories SET type = 'Renamed elsewhere' WHERE id = 1")
+            db.session.execute("UPDATE data_versions SET version = version + 1 WHERE name = 'categories'")
+        data = json.loads(self.client().get('/categories').data)
+
+        self.assertEqual(data['categories']['1'], 'Renamed elsewhere')
+
+
+    def test_category_snapshot_reused_until_categories_change(self):
+        self.client().get('/categories')
+        hits = category_snapshot.stats()['hits']
+        self.client().get('/questions')
+        self.assertEqual(category_snapshot.stats()['hits'], hits + 1)
+
+        with self.app.app_context():
+            category = Category(type = 'Snapshot test')
+            db.session.add(category)
+            db.session.commit()
+            category_id = category.id
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(data['categories'][str(category_id)], 'Snapshot test')
+
+        with self.app.app_context():
+            db.session.delete(Category.query.get(category_id))
+            db.session.commit()
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertNotIn(str(category_id), data['categories'])
+
+
+    def test_304_when_questions_unchanged(self):
+        res = self.client().get('/questions?page=1')
+        etag = res.headers['ETag']
+
+        res = self.client().get('/questions?page=1', headers = {'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        self.client().post('/questions', json = self.new_question)
+        res = self.client().get('/questions?page=1', headers = {'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+
+    def test_category_etag_ignores_question_writes(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        self.client().post('/questions', json = self.new_question)
+
+        res = self.client().get('/categories', headers = {'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+
+    def test_etag_changes_after_batch_writes(self):
+        res = self.client().get('/categories/1/questions')
+        etag = res.headers['ETag']
+        self.client().post('/questions/bulk', json = [self.new_question])
+
+        res = self.client().get('/categories/1/questions', headers = {'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+
+
+    def test_response_cache_serves_listings_until_a_write(self):
+        cache = self.app.extensions['response_cache']
+        first = self.client().get('/questions?page=1')
+        hits = cache.hits
+        res = self.client().get('/questions?page=1')
+
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(res.data, first.data)
+        self.assertEqual(res.headers['ETag'], first.headers['ETag'])
+
+        self.client().post('/questions', json = self.new_question)
+        res = self.client().get('/questions?page=1')
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(json.loads(res.data)['total_questions'],
+                         json.loads(first.data)['total_questions'] + 1)
+
+
+    def test_response_cache_shared_between_apps(self):
+        self.client().get('/categories/1/questions')
+        app = self.build_app()
+        cache = app.extensions['response_cache']
+
+        res = app.test_client().get('/categories/1/questions')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 0)
+
+
+    def test_response_cache_evicts_least_recently_used(self):
+        cache = SQLiteCache(os.path.join(self.cache_dir, 'lru.sqlite3'), ttl=60, max_entries=2, touch_after=0)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        cache.get('a')
+        cache.set('c', b'3')
+        cache.evict()
+
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), b'3')
+
+
+    def test_response_cache_hits_rarely_write(self):
+        cache = SQLiteCache(os.path.join(self.cache_dir, 'touch.sqlite3'), ttl=60, max_entries=2)
+        cache.set('a', b'1')
+        used = cache._connection().execute("SELECT used FROM responses WHERE key = 'a'").fetchone()
+        cache.get('a')
+
+        self.assertEqual(cache._connection().execute("SELECT used FROM responses WHERE key = 'a'").fetchone(), used)
+
+
+    def test_failing_response_cache_falls_through_to_the_view(self):
+        class UnreachableCache:
+            def get(self, key):
+                raise ConnectionError('cache is down')
+            def set(self, key, value):
+                raise ConnectionError('cache is down')
+
+        res = self.build_app(RESPONSE_CACHE = UnreachableCache()).test_client().get('/questions?page=1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(json.loads(res.data)['questions']))
+
+
+    def test_redis_response_cache(self):
+        class RedisStandIn(dict):
+            def set(self, key, value, px=None):
+                self[key] = value
+            def scan_iter(self, match):
+                return [key for key in self if key.startswith(match.rstrip('*'))]
+            def delete(self, *keys):
+                for key in keys:
+                    self.pop(key)
+
+        client = RedisStandIn()
+        app = self.build_app(RESPONSE_CACHE=RedisCache(client))
+        first = app.test_client().get('/questions?page=1')
+        res = app.test_client().get('/questions?page=1')
+
+        self.assertEqual(len(client), 1)
+        self.assertEqual(app.extensions['response_cache'].hits, 1)
+        self.assertEqual(res.data, first.data)
+
+
+    def test_gzip_negotiated_for_large_listings(self):
+        plain = self.client().get('/questions?after_id=&limit=100')
+        res = self.client().get('/questions?after_id=&limit=100', headers = {'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(res.data)), json.loads(plain.data))
+        self.assertTrue(len(res.data) < len(plain.data))
+
+        res = self.client().get('/questions?after_id=&limit=100',
+                                headers = {'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+
+    def test_small_responses_sent_uncompressed(self):
+        res = self.client().get('/categories', headers = {'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+
+
+    def test_streamed_export_compressed(self):
+        plain = self.client().get('/questions/export')
+        res = self.client().get('/questions/export', headers = {'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+
+    def test_stdlib_serializer_matches_default(self):
+        app = self.build_app(JSON_SERIALIZER='stdlib', COMPRESSION=[])
+        res = app.test_client().get('/questions', headers = {'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(json.loads(res.data), json.loads(self.client().get('/questions').data))
+
+
     #route('/search_questions', methods = ['POST'])
     def test_search_question(self):
         res = self.client().post('/search_questions', json = {'search_term': 'title'})
         data = json.loads(res.data)
-        search_term = 'title'
-        selection = Question.query.filter(Question.question.ilike("%{}%".format(search_term))).order_by('id').all()
         
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['questions']))
-        self.assertEqual(data['total_questions'], len(selection))
+        self.assertEqual(data['total_questions'], len(data['questions']))
+        for question in data['questions']:
+            self.assertIn('title', question['question'].lower())
+
+
+    def test_search_matches_answers(self):
+        res = self.client().post('/search_questions', json = {'search_term': 'Scarab'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([question['answer'] for question in data['questions']], ['Scarab'])
+
+
+    def test_search_in_memory_backend(self):
+        app = self.build_app(SEARCH_BACKEND='memory')
+        res = app.test_client().post('/search_questions', json = {'search_term': 'soccer world cup'})
+        data = json.loads(res.data)
+        expected = Question.query.filter(Question.question.ilike('%soccer World Cup%')).count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], expected)
+        for question in data['questions']:
+            self.assertIn('soccer world cup', question['question'].lower())
 
 
     def test_search_error(self):
@@ -84,6 +478,205 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "Sorry, couldn't process your request :(")
 
+    def test_trigram_search_tolerates_typos_and_fragments(self):
+        app = self.build_app(SEARCH_BACKEND='memory')
+        client = app.test_client()
+
+        for search_term in ['penicilin', 'penicil']:
+            res = client.post('/search_questions', json = {'search_term': search_term, 'mode': 'trigram'})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['questions'][0]['question'], 'Who discovered penicillin?')
+
+
+    def test_trigram_search_on_postgres(self):
+        if not db.session.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar():
+            self.skipTest('pg_trgm is not installed')
+        res = self.client().post('/search_questions', json = {'search_term': 'penicilin', 'mode': 'trigram'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['question'], 'Who discovered penicillin?')
+
+
+    def test_422_unknown_search_mode(self):
+        res = self.client().post('/search_questions', json = {'search_term': 'title', 'mode': 'regex'})
+
+        self.assertEqual(res.status_code, 422)
+
+
+    #route('/questions/suggest')
+    def test_suggest_questions_by_word_prefix(self):
+        with self.app.app_context():
+            suggest_index.build()
+        res = self.client().get('/questions/suggest?prefix=Soccer Wor')
+        data = json.loads(res.data)
+        expected = Question.query.filter(Question.question.ilike('%soccer world%')).count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['suggestions']), expected)
+        for suggestion in data['suggestions']:
+            self.assertIn('soccer world', suggestion['question'].lower())
+
+
+    def test_suggest_follows_inserts_and_deletes(self):
+        with self.app.app_context():
+            suggest_index.build()
+        question = dict(self.new_question, question = 'Which planet has the Great Red Spot?')
+        res = self.client().post('/questions', json = question)
+        question_id = json.loads(res.data)['posted']['id']
+
+        res = self.client().get('/questions/suggest?prefix=great red sp')
+        data = json.loads(res.data)
+        self.assertIn(question_id, [suggestion['id'] for suggestion in data['suggestions']])
+
+        self.client().delete('/questions/{}'.format(question_id))
+        res = self.client().get('/questions/suggest?prefix=great red sp')
+        data = json.loads(res.data)
+        self.assertNotIn(question_id, [suggestion['id'] for suggestion in data['suggestions']])
+
+
+    def test_suggest_requests_only_read_the_index(self):
+        with self.app.app_context():
+            suggest_index.build()
+            db.session.execute("INSERT INTO questions (question, answer, difficulty, category_id) "
+                               "VALUES ('Who painted the zebra crossing?', 'Nobody', 1, 2)")
+        invalidate_caches()
+        res = self.client().get('/questions/suggest?prefix=zebra cross')
+        self.assertEqual(json.loads(res.data)['suggestions'], [])
+
+        with self.app.app_context():
+            suggest_index.build()
+        res = self.client().get('/questions/suggest?prefix=zebra cross')
+        self.assertEqual(len(json.loads(res.data)['suggestions']), 1)
+
+
+    #route('/questions/bulk', methods = ['POST'])
+    def test_bulk_import_reports_row_errors(self):
+        total = Question.query.count()
+        questions = [
+            dict(self.new_question, question = 'Bulk question {}'.format(number))
+            for number in range(3)
+        ]
+        questions.insert(1, dict(self.new_question, category = 500))
+        questions.append({'answer': 'No question'})
+        res = self.client().post('/questions/bulk', json = questions)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 3)
+        self.assertEqual([error['row'] for error in data['errors']], [2, 5])
+        self.assertEqual(data['total_questions'], total + 3)
+        self.assertEqual(Question.query.filter(Question.question.like('Bulk question %')).count(), 3)
+
+
+    def test_bulk_import_ndjson(self):
+        lines = [json.dumps(self.new_question), 'not json', json.dumps(self.new_question)]
+        res = self.client().post('/questions/bulk', data = '\n'.join(lines),
+                                 content_type = 'application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [2])
+
+
+    def test_bulk_import_isolates_rows_the_database_rejects(self):
+        questions = [self.new_question, dict(self.new_question, difficulty = 2 ** 40), self.new_question]
+        res = self.client().post('/questions/bulk', json = questions)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [2])
+
+
+    def test_import_questions_command(self):
+        runner = self.app.test_cli_runner()
+        with runner.isolated_filesystem():
+            with open('questions.ndjson', 'w') as source:
+                source.write(json.dumps(self.new_question) + '\n')
+            result = runner.invoke(args = ['import-questions', 'questions.ndjson'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Imported 1 questions, rejected 0', result.output)
+
+
+    def test_422_bulk_import_not_an_array(self):
+        res = self.client().post('/questions/bulk', json = self.new_question)
+
+        self.assertEqual(res.status_code, 422)
+
+
+    #route('/questions', methods = ['DELETE', 'PATCH'])
+    def test_batch_delete_questions(self):
+        res = self.client().post('/questions/bulk', json = [self.new_question] * 3)
+        ids = [question.id for question in Question.query.order_by(Question.id.desc()).limit(3).all()]
+        total = Question.query.count()
+
+        res = self.client().delete('/questions', json = {'ids': ids + [100000]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted_questions'], sorted(ids))
+        self.assertEqual(data['total_questions'], total - 3)
+        self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(), 0)
+
+
+    def test_batch_update_questions(self):
+        self.client().post('/questions/bulk', json = [self.new_question] * 2)
+        ids = [question.id for question in Question.query.order_by(Question.id.desc()).limit(2).all()]
+
+        res = self.client().patch('/questions', json = {'ids': ids, 'changes': {'difficulty': 1, 'category': 2}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated_questions'], sorted(ids))
+        for question in Question.query.filter(Question.id.in_(ids)).all():
+            self.assertEqual((question.difficulty, question.category_id), (1, 2))
+
+
+    def test_422_batch_update_unknown_category(self):
+        res = self.client().patch('/questions', json = {'ids': [1], 'changes': {'category': 500}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+
+    def test_404_batch_delete_missing_questions(self):
+        res = self.client().delete('/questions', json = {'ids': [100000, 100001]})
+
+        self.assertEqual(res.status_code, 404)
+
+
+    #route('/questions/export')
+    def test_export_questions_as_ndjson(self):
+        res = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), Question.query.count())
+        self.assertEqual(rows[0], Question.query.order_by(Question.id).first().format())
+
+
+    def test_export_questions_as_csv(self):
+        res = self.client().get('/questions/export?format=csv&category=1')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,difficulty,category_id')
+        self.assertEqual(len(lines) - 1, Question.query.filter(Question.category_id == 1).count())
+
+
+    def test_400_export_unknown_format(self):
+        res = self.client().get('/questions/export?format=xml')
+
+        self.assertEqual(res.status_code, 400)
+
+
     #route("/categories/<int:category_id>/questions")
     def test_get_questions_by_category(self):
         res = self.client().get('/categories/1/questions')
@@ -145,6 +738,213 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], "Sorry, couldn't find a resource matching your request :(")
 
 
+    def test_play_quiz_skips_previous_questions(self):
+        ids = [question.id for question in Question.query.filter(Question.category_id == 4).all()]
+        message = {'previous_questions': ids[1:], 'quiz_category': {'type': 'History', 'id': 4}}
+        res = self.client().post('/quizzes', json = message)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], ids[0])
+        self.assertEqual(data['quiz_exhausted'], False)
+
+
+    def test_play_quiz_exhausted(self):
+        ids = [question.id for question in Question.query.filter(Question.category_id == 4).all()]
+        message = {'previous_questions': ids, 'quiz_category': 4}
+        res = self.client().post('/quizzes', json = message)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question'], None)
+        self.assertEqual(data['quiz_exhausted'], True)
+
+
+    def test_422_play_quiz_without_body(self):
+        res = self.client().post('/quizzes')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+
+    def test_alias_table_follows_weights(self):
+        table = AliasTable([1, 2, 3, 4], [1, 2, 0, 7])
+        rng = random.Random(0)
+        picks = Counter(table.pick(rng) for _ in range(100000))
+
+        self.assertEqual(picks[3], 0)
+        for outcome, share in ((1, 0.1), (2, 0.2), (4, 0.7)):
+            self.assertAlmostEqual(picks[outcome] / 100000, share, delta=0.01)
+
+
+    def test_weighted_sample_follows_difficulty_weights(self):
+        weights = {3: 1, 4: 3}
+        with self.app.app_context():
+            buckets = question_pool.buckets()
+            draws = Counter()
+            for _ in range(4000):
+                question_id = question_pool.sample_weighted(None, 1, weights = weights)[0]
+                draws[next(d for d, ids in buckets.items() if question_id in ids)] += 1
+
+        self.assertEqual(set(draws), {3, 4})
+        self.assertAlmostEqual(draws[4] / 4000, 0.75, delta=0.03)
+
+
+    def test_play_quiz_with_difficulty_weights(self):
+        message = {'previous_questions': [], 'quiz_category': 0, 'count': 5,
+                   'difficulty_weights': {'1': 1}}
+        res = self.client().post('/quizzes/batch', json = message)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['questions']) > 0)
+        self.assertTrue(all(question['difficulty'] == 1 for question in data['questions']))
+
+
+    def test_play_quiz_difficulty_ramp(self):
+        res = self.client().post('/quizzes', json = {'quiz_category': 0, 'difficulty_ramp': True})
+        self.assertEqual(res.status_code, 200)
+
+        with self.app.app_context():
+            difficulties = sorted(question_pool.buckets())
+            start = question_pool.ramp_weights(None, 0, step = 3)
+            later = question_pool.ramp_weights(None, 3, step = 3)
+            end = question_pool.ramp_weights(None, 1000, step = 3)
+        self.assertEqual(max(start, key = start.get), difficulties[0])
+        self.assertEqual(max(later, key = later.get), difficulties[1])
+        self.assertEqual(max(end, key = end.get), difficulties[-1])
+
+
+    def test_quiz_redraws_after_another_worker_deletes(self):
+        with self.app.app_context():
+            ids = list(question_pool.ids(4))
+            other_category = question_pool.ids(2)
+            # another worker swaps a question for a new one; this pool does not see it
+            db.session.execute("DELETE FROM questions WHERE id = :id", {'id': ids[0]})
+            db.session.execute("INSERT INTO questions (question, answer, difficulty, category_id) "
+                               "VALUES ('Added elsewhere', 'Yes', 1, 4)")
+            drawn = question_pool.draw(4, exclude = set(ids[1:]))
+
+            self.assertEqual(len(drawn), 1)
+            self.assertEqual(drawn[0]['question'], 'Added elsewhere')
+            self.assertIs(question_pool.ids(2), other_category)
+
+
+    def test_422_play_quiz_negative_weights(self):
+        res = self.client().post('/quizzes', json = {'quiz_category': 4, 'difficulty_weights': {'1': -1}})
+        self.assertEqual(res.status_code, 422)
+
+
+    #route('/quizzes/batch', methods = ['POST'])
+    def test_quiz_batch_returns_distinct_unseen_questions(self):
+        ids = [question.id for question in Question.query.filter(Question.category_id == 4).all()]
+        message = {'quiz_category': 4, 'count': 10, 'previous_questions': ids[:1]}
+        res = self.client().post('/quizzes/batch', json = message)
+        data = json.loads(res.data)
+        returned = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(returned), sorted(ids[1:]))
+        self.assertEqual(data['quiz_exhausted'], len(ids) - 1 < 10)
+
+
+    def test_422_quiz_batch_invalid_count(self):
+        res = self.client().post('/quizzes/batch', json = {'quiz_category': 4, 'count': 0})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+
+    #route('/quizzes/sessions')
+    def test_quiz_session_deals_each_question_once(self):
+        res = self.client().post('/quizzes/sessions', json = {'quiz_category': 4})
+        data = json.loads(res.data)
+        session_id = data['session_id']
+        expected = {question.id for question in Question.query.filter(Question.category_id == 4).all()}
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], len(expected))
+
+        dealt = []
+        for _ in range(len(expected)):
+            res = self.client().post('/quizzes/sessions/{}/next'.format(session_id))
+            dealt.append(json.loads(res.data)['question']['id'])
+        res = self.client().post('/quizzes/sessions/{}/next'.format(session_id))
+        data = json.loads(res.data)
+
+        self.assertEqual(sorted(dealt), sorted(expected))
+        self.assertEqual(data['question'], None)
+        self.assertEqual(data['quiz_exhausted'], True)
+
+
+    def test_404_unknown_quiz_session(self):
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+
+    def test_quiz_session_store_expires_idle_sessions(self):
+        store = MemoryDeckStore(ttl = 0)
+        session_id = store.create([1, 2, 3])
+
+        with self.assertRaises(KeyError):
+            store.pop(session_id)
+        self.assertEqual(len(store), 0)
+
+
+    def test_quiz_session_store_drops_least_recently_played(self):
+        store = MemoryDeckStore(max_sessions = 2)
+        first = store.create([1, 2])
+        second = store.create([3, 4])
+        store.pop(first)
+        store.create([5, 6])
+
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.pop(first), 1)
+        with self.assertRaises(KeyError):
+            store.pop(second)
+
+
+    def test_redis_quiz_session_store(self):
+        class RedisStandIn(dict):
+            def rpush(self, key, *values):
+                self.setdefault(key, []).extend(str(value).encode() for value in values)
+            def rpop(self, key):
+                values = self.get(key)
+                if not values:
+                    return None
+                value = values.pop()
+                if not values:
+                    del self[key]
+                return value
+            def pexpire(self, key, milliseconds):
+                pass
+            def delete(self, *keys):
+                for key in keys:
+                    self.pop(key, None)
+
+        client = RedisStandIn()
+        app = self.build_app(QUIZ_SESSION_STORE = RedisDeckStore(client))
+        res = app.test_client().post('/quizzes/sessions', json = {'quiz_category': 4})
+        data = json.loads(res.data)
+        session_id = data['session_id']
+
+        dealt = [json.loads(app.test_client().post('/quizzes/sessions/{}/next'.format(session_id)).data)
+                 for _ in range(data['total_questions'] + 2)]
+        self.assertEqual(len({round['question']['id'] for round in dealt[:-2]}), data['total_questions'])
+        self.assertEqual([round['quiz_exhausted'] for round in dealt[-2:]], [True, True])
+
+        app.test_client().delete('/quizzes/sessions/{}'.format(session_id))
+        res = app.test_client().post('/quizzes/sessions/{}/next'.format(session_id))
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(len(client), 0)
+
+
     #route('/questions', methods = ['POST'])
     def test_post_new_question(self):
         res = self.client().post('/questions', json = self.new_question)
@@ -156,6 +956,14 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
     
 
+    def test_post_new_question_reports_table_count(self):
+        res = self.client().post('/questions', json = self.new_question)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+
     def test_post_question_not_possible(self):
         res = self.client().post('/questions')
         data = json.loads(res.data)
@@ -176,6 +984,223 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
     
 
+    def test_metrics_in_prometheus_format(self):
+        client = self.build_app().test_client()
+        client.get('/questions?page=1')
+        client.get('/questions?page=1000')
+        res = client.get('/metrics')
+        body = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('trivia_requests_total{endpoint="/questions",method="GET",status="200"} 1', body)
+        self.assertIn('trivia_requests_total{endpoint="/questions",method="GET",status="404"} 1', body)
+        self.assertIn('trivia_request_duration_seconds_count{endpoint="/questions",method="GET"} 2', body)
+        self.assertIn('trivia_request_sql_statements_bucket{endpoint="/questions",method="GET",le="0"} 0', body)
+        self.assertIn('trivia_response_size_bytes_count{endpoint="/questions",method="GET"} 2', body)
+
+
+    def test_server_timing_header(self):
+        app = self.build_app(SERVER_TIMING=True)
+        res = app.test_client().get('/categories/1/questions')
+
+        self.assertRegex(res.headers['Server-Timing'], r'^db;dur=[0-9.]+;desc="[1-9][0-9]* queries", total;dur=[0-9.]+$')
+        self.assertNotIn('Server-Timing', self.client().get('/categories').headers)
+
+
+    def test_server_timing_counts_only_the_request(self):
+        app = self.build_app(SERVER_TIMING=True)
+        client = app.test_client()
+        client.get('/categories/1/questions')
+        # requests inside one app context share its g; each reads the cached data versions
+        with app.app_context():
+            timings = [client.get('/categories/1/questions').headers['Server-Timing'] for _ in range(4)]
+
+        for timing in timings:
+            self.assertRegex(timing, r'desc="[12] queries"')
+
+
+    def test_pool_options_from_config(self):
+        app = self.build_app(DB_POOL_SIZE=3, DB_MAX_OVERFLOW=2, DB_POOL_TIMEOUT=5,
+                             DB_POOL_PRE_PING=True)
+        # requests run on the test transaction, so check out from this app's own pool
+        with app.app_context():
+            db.engine.connect().close()
+        res = app.test_client().get('/internal/pool')
+        pool = json.loads(res.data)['pool']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(pool['pool_class'], 'MeteredQueuePool')
+        self.assertEqual(pool['size'], 3)
+        self.assertEqual(pool['max_overflow'], 2)
+        self.assertEqual(pool['timeout'], 5)
+        self.assertEqual(pool['checked_out'], 0)
+        self.assertTrue(pool['checked_in'] >= 1)
+        self.assertTrue(pool['checkouts'] >= 1)
+        self.assertIn('database_max_connections', pool)
+
+
+    def test_404_pool_stats_from_outside(self):
+        res = self.client().get('/internal/pool', environ_base = {'REMOTE_ADDR': '203.0.113.7'})
+        self.assertEqual(res.status_code, 404)
+
+
+    def test_404_metrics_from_outside(self):
+        res = self.client().get('/metrics', environ_base = {'REMOTE_ADDR': '203.0.113.7'})
+        self.assertEqual(res.status_code, 404)
+
+
+    def build_app(self, **config):
+        """An app of the test's own; its pool is closed afterwards, so the worker database can be dropped."""
+        app = create_app(dict(self.config, **config))
+        self.addCleanup(db.get_engine(app).dispose)
+        return app
+
+
+    def replica_database(self):
+        """A database standing in for a read replica, holding one question; built once per run."""
+        cls = type(self)
+        if getattr(cls, 'replica_path', None) is None:
+            name = '{}_replica'.format(cls.database_name)
+            maintenance('DROP DATABASE IF EXISTS {}'.format(name), 'CREATE DATABASE {}'.format(name))
+            cls.replica_path = 'postgresql:///{}'.format(name)
+            engine = create_engine(cls.replica_path)
+            db.Model.metadata.create_all(engine)
+            engine.execute(Category.__table__.insert(), [{'id': 1, 'type': 'Science'}])
+            engine.execute(Question.__table__.insert(), [{'question': 'Only on the replica', 'answer': 'Yes',
+                                                          'difficulty': 1, 'category_id': 1}])
+            engine.dispose()
+        return cls.replica_path
+
+
+    def replica_app(self, replicas, **config):
+        app = self.build_app(SQLALCHEMY_REPLICA_URIS = replicas, RESPONSE_CACHE = None, **config)
+        for engine in app.extensions['replicas'].engines:
+            self.addCleanup(engine.dispose)
+        return app
+
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        app = self.replica_app([self.replica_database()])
+        client = app.test_client()
+        listing = json.loads(client.get('/questions').data)
+        quiz = client.post('/quizzes', json = {'quiz_category': 0, 'previous_questions': []})
+        pooled = list(question_pool.ids())
+        res = client.post('/questions', json = self.new_question)
+
+        self.assertEqual([question['question'] for question in listing['questions']], ['Only on the replica'])
+        self.assertEqual(quiz.status_code, 200)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Set-Cookie', res.headers)
+        with self.app.app_context():
+            self.assertEqual(Question.query.filter(Question.question == self.new_question['question']).count(), 1)
+            # the quiz pool is filled from the primary, never from a lagging replica
+            self.assertEqual(len(pooled), Question.query.count() - 1)
+
+
+    def test_read_your_writes_after_a_write(self):
+        app = self.replica_app([self.replica_database()], READ_YOUR_WRITES = 5)
+        client = app.test_client()
+        res = client.post('/questions', json = self.new_question)
+        listing = json.loads(client.get('/questions').data)
+
+        self.assertIn('trivia_primary_until=', res.headers['Set-Cookie'])
+        self.assertGreater(listing['total_questions'], 1)
+        self.assertNotIn('Only on the replica', [question['question'] for question in listing['questions']])
+
+
+    def test_quiz_draws_questions_a_replica_lacks_from_the_primary(self):
+        app = self.replica_app([self.replica_database()])
+        with self.app.app_context():
+            expected = {question.id: question.question for question in Question.query.filter(Question.category_id == 1)}
+            other_category = question_pool.ids(2)
+        # the pool comes from the primary; the replica only has its one question, id 1
+        res = app.test_client().post('/quizzes', json = {'quiz_category': 1, 'previous_questions': [1]})
+        question = json.loads(res.data)['question']
+
+        self.assertEqual(question['question'], expected[question['id']])
+        with self.app.app_context():
+            self.assertIs(question_pool.ids(2), other_category)
+
+
+    def test_unreachable_replica_is_ejected(self):
+        unreachable = 'postgresql:///{}_missing'.format(self.database_name)
+        app = self.replica_app([unreachable, self.replica_database()])
+        client = app.test_client()
+        responses = [json.loads(client.get('/questions').data) for _ in range(3)]
+        replicas = app.extensions['replicas']
+
+        for data in responses:
+            self.assertEqual(data['questions'][0]['question'], 'Only on the replica')
+        self.assertEqual([replicas.healthy(engine) for engine in replicas.engines], [False, True])
+        self.assertEqual(replicas.ejections[replicas.engines[0]], 1)
+
+
+    def asgi_client(self, **config):
+        """The async serving mode; it only sees committed rows, so tests stay read-only."""
+        if create_asgi_app is None:
+            self.skipTest('the async serving mode needs starlette, databases and a2wsgi')
+        asgi_app = create_asgi_app(dict(self.config, **config))
+        self.addCleanup(db.get_engine(asgi_app.state.flask_app).dispose)
+        return TestClient(asgi_app, headers = {'Accept-Encoding': 'identity'})
+
+
+    def test_async_reads_match_flask(self):
+        paths = ['/categories', '/categories/stats', '/questions', '/questions?page=2', '/questions?page=1000',
+                 '/questions?after_id=Mg&limit=3', '/questions?after_id=***', '/categories/1/questions',
+                 '/categories/1000/questions']
+        with self.asgi_client() as client:
+            for path in paths:
+                res = client.get(path)
+                expected = self.client().get(path)
+
+                self.assertEqual(res.status_code, expected.status_code, path)
+                self.assertEqual(res.json(), json.loads(expected.data), path)
+                self.assertEqual(res.headers.get('ETag'), expected.headers.get('ETag'), path)
+
+            res = client.post('/search_questions', json = {'search_term': 'title'})
+            expected = self.client().post('/search_questions', json = {'search_term': 'title'})
+            self.assertEqual(res.json(), json.loads(expected.data))
+
+
+    def test_async_conditional_get(self):
+        with self.asgi_client() as client:
+            etag = client.get('/questions').headers['ETag']
+            res = client.get('/questions', headers = {'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, b'')
+
+
+    def test_async_quiz(self):
+        with self.asgi_client() as client:
+            res = client.post('/quizzes', json = {'quiz_category': {'id': 1, 'type': 'Science'},
+                                                  'previous_questions': [20], 'difficulty_ramp': True})
+            missing = client.post('/quizzes', json = {'quiz_category': 1000, 'previous_questions': []})
+            invalid = client.post('/quizzes', json = {'quiz_category': 'science'})
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['category_id'], 1)
+        self.assertNotEqual(data['question']['id'], 20)
+        self.assertEqual(data['quiz_exhausted'], False)
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(invalid.status_code, 422)
+        self.assertEqual(invalid.json()['message'], "Sorry, couldn't process your request :(")
+
+
+    def test_async_requests_in_metrics(self):
+        # the test client connects from 'testclient'
+        with self.asgi_client(INTERNAL_ADDRESSES = ('testclient',)) as client:
+            client.get('/categories')
+            # /metrics has no async handler and is served by the flask app
+            res = client.get('/metrics')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_total{endpoint="/categories",method="GET",status="200"} 1', res.text)
+        self.assertIn('trivia_request_sql_statements_count{endpoint="/categories",method="GET"} 1', res.text)
+
+
     def test_404_if_question_does_not_exist(self):
         res = self.client().delete('/questions/500')
         data = json.loads(res.data)